@@ -0,0 +1,364 @@
+"""
+端到端压测：在本地起一个假的 Telegram Bot API（可注入延迟和 429），通过 TELEGRAM_API_BASE 让机器人指向它，
+用真实的 Flask app 接收 webhook，按比例混合发送新用户留言、彩蛋命中、模糊未命中、管理员回复、按钮点击和 /broadcast，
+统计不同数据库规模下的吞吐、端到端延迟（webhook 收到 -> 工作线程处理完）和各 API 方法的调用次数。
+
+每个数据库规模在独立的子进程和临时目录中运行，互不影响。
+
+用法:
+    python bench/e2e.py
+    python bench/e2e.py --db-sizes 1000 100000 1000000 --updates 5000 --concurrency 16
+    python bench/e2e.py --stub-latency-ms 50 --rate-429 0.01
+    python bench/e2e.py --limits both   # 生产默认限流与放开限流两种配置并排对比
+    python bench/e2e.py --rate 30   # 固定到达速率，看延迟分布
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FUZZY_MISSES = ["请问我的订单什么时候发货", "快递一直没有更新物流信息怎么办", "能不能帮我改一下收货地址",
+                "我想咨询一下会员的价格", "昨天买的东西还没到", "账号登录不上去了", "为什么扣了两次钱",
+                "how long does shipping take", "can I change my order", "the app keeps crashing"]
+HUMAN_TEXTS = ["转人工", "我要人工客服"]
+
+
+# --- 假的 Bot API ---
+class StubState:
+    def __init__(self, latency_ms, rate_429, retry_after):
+        self.latency_ms = latency_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.throttled = 0
+        self.message_id = 1000
+
+    def next_message_id(self):
+        with self.lock:
+            self.message_id += 1
+            return self.message_id
+
+
+def make_stub(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # 头和正文分两次写出，不关 Nagle 的话每个请求会多等一个延迟 ACK（约 40ms）
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            method = self.path.rsplit("/", 1)[-1]
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            with state.lock:
+                state.calls[method] = state.calls.get(method, 0) + 1
+            if state.latency_ms:
+                time.sleep(state.latency_ms / 1000 * random.uniform(0.5, 1.5))
+
+            if state.rate_429 and random.random() < state.rate_429:
+                with state.lock:
+                    state.throttled += 1
+                status = 429
+                body = {"ok": False, "error_code": 429,
+                        "description": f"Too Many Requests: retry after {state.retry_after}",
+                        "parameters": {"retry_after": state.retry_after}}
+            elif method in ("sendMessage", "editMessageText"):
+                status = 200
+                body = {"ok": True, "result": {"message_id": state.next_message_id()}}
+            else:
+                status = 200
+                body = {"ok": True, "result": True}
+
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- update 生成 ---
+class UpdateFactory:
+    def __init__(self, admin_id, db_size, egg_keywords, seed):
+        self.admin_id = admin_id
+        self.db_size = db_size
+        self.egg_keywords = egg_keywords
+        self.rng = random.Random(seed)
+        self.update_id = 0
+        self.message_id = 0
+        self.new_user_id = 10 ** 9
+
+    def _ids(self):
+        self.update_id += 1
+        self.message_id += 1
+        return self.update_id, self.message_id
+
+    def existing_user(self):
+        return self.rng.randrange(1, self.db_size + 1)
+
+    def message(self, user_id, text, **extra):
+        update_id, message_id = self._ids()
+        message = {"message_id": message_id, "from": {"id": user_id, "username": f"u{user_id}"},
+                   "chat": {"id": user_id}, "date": int(time.time()), "text": text}
+        message.update(extra)
+        return {"update_id": update_id, "message": message}
+
+    def callback(self, user_id, data):
+        update_id, message_id = self._ids()
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": {"id": user_id}, "data": data,
+            "message": {"message_id": message_id, "chat": {"id": user_id}}}}
+
+    def make(self, kind):
+        if kind == "new_user":
+            self.new_user_id += 1
+            return self.message(self.new_user_id, "/start")
+        if kind == "egg_hit":
+            keyword = self.rng.choice(self.egg_keywords)
+            return self.message(self.existing_user(), f"{keyword}，{self.rng.choice(FUZZY_MISSES)}")
+        if kind == "fuzzy_miss":
+            text = self.rng.choice(FUZZY_MISSES + HUMAN_TEXTS if self.rng.random() < 0.1 else FUZZY_MISSES)
+            return self.message(self.existing_user(), text)
+        if kind == "admin_reply":
+            target = self.existing_user()
+            prompt = {"message_id": self.rng.randrange(1, 10 ** 6), "chat": {"id": self.admin_id},
+                      "text": f"💬 请直接回复此消息来回复用户 {target}：\n\n用户ID: {target}"}
+            return self.message(self.admin_id, "您好，问题已经处理，请查收。", reply_to_message=prompt)
+        if kind == "callback":
+            if self.rng.random() < 0.5:
+                return self.callback(self.admin_id, f"reply_{self.existing_user()}")
+            return self.callback(self.existing_user(), "to_human")
+        if kind == "broadcast":
+            return self.message(self.admin_id, "/broadcast 压测广播消息")
+        raise ValueError(kind)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# --- 子进程：单个数据库规模 ---
+def seed_database(main, db_size):
+    data = main.load_data()
+    now = int(time.time())
+    data["users"] = {str(i): {"username": f"u{i}", "first_seen": now, "messages_count": 0}
+                     for i in range(1, db_size + 1)}
+    data["stats"]["users_count"] = db_size
+    main.save_data(data)
+    main.STORE.flush()
+
+
+def run_child(args):
+    work = tempfile.mkdtemp(prefix="bot-e2e-")
+    shutil.copy(os.path.join(ROOT, "keywords.json"), work)
+    os.chdir(work)
+    sys.path.insert(0, ROOT)
+
+    stub_state = StubState(args.stub_latency_ms, args.rate_429, args.retry_after)
+    stub = make_stub(stub_state)
+    os.environ["TELEGRAM_API_BASE"] = f"http://127.0.0.1:{stub.server_address[1]}"
+    if args.limits == "relaxed":
+        # 放开出站限流和防刷，只看处理本身的开销；默认（production）使用 main.py 中的默认值（或环境变量）
+        for name, value in (("TELEGRAM_GLOBAL_RATE", "100000"), ("TELEGRAM_CHAT_RATE", "100000"),
+                            ("TELEGRAM_CHAT_BURST", "100000"), ("FLOOD_RATE", "100000"),
+                            ("FLOOD_BURST", "100000")):
+            os.environ.setdefault(name, value)
+    os.environ.setdefault("WEBHOOK_QUEUE_SIZE", str(args.updates + 1000))
+
+    import logging
+    import main  # noqa: E402
+    from werkzeug.serving import make_server  # noqa: E402
+    logging.getLogger().setLevel(logging.WARNING)
+
+    start = time.perf_counter()
+    seed_database(main, args.db_size)
+    seed_seconds = time.perf_counter() - start
+    # 预热分词器和词库缓存，冷启动不计入结果
+    main.semantic_match("预热一下分词器")
+
+    submitted = {}
+    finished = {}
+    lock = threading.Lock()
+    handler = main.DISPATCHER.handler
+
+    def timed_handler(update):
+        try:
+            handler(update)
+        finally:
+            with lock:
+                finished[update["update_id"]] = time.perf_counter()
+
+    main.DISPATCHER.handler = timed_handler
+    main.DISPATCHER.start()
+
+    server = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    webhook_url = f"http://127.0.0.1:{server.server_port}/webhook"
+
+    egg_keywords = [k for egg in main.KEYWORDS.get().eggs for k in egg["keywords"] if len(k) > 1]
+    factory = UpdateFactory(main.ADMIN_ID, args.db_size, egg_keywords, args.seed)
+    weights = {"new_user": args.mix_new_user, "egg_hit": args.mix_egg_hit, "fuzzy_miss": args.mix_fuzzy_miss,
+               "admin_reply": args.mix_admin_reply, "callback": args.mix_callback}
+    kinds = factory.rng.choices(list(weights), weights=list(weights.values()), k=args.updates)
+    for i in range(args.broadcasts):
+        kinds[(i + 1) * len(kinds) // (args.broadcasts + 1)] = "broadcast"
+    updates = [factory.make(kind) for kind in kinds]
+
+    import requests  # noqa: E402
+    webhook_latencies = []
+    statuses = {}
+    position = iter(range(len(updates)))
+    position_lock = threading.Lock()
+    calls_before = dict(stub_state.calls)
+
+    def client():
+        session = requests.Session()
+        while True:
+            with position_lock:
+                index = next(position, None)
+            if index is None:
+                return
+            update = updates[index]
+            if args.rate:
+                # 按固定到达速率发送，延迟才不会被压测本身堆起来的队列淹没
+                delay = start + index / args.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            sent = time.perf_counter()
+            with lock:
+                submitted[update["update_id"]] = sent
+            response = session.post(webhook_url, json=update, timeout=30)
+            elapsed = time.perf_counter() - sent
+            with lock:
+                webhook_latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    main.DISPATCHER.drain(timeout=args.timeout)
+    elapsed = time.perf_counter() - start
+
+    # 等后台发件箱把通知发完，出站计数才完整
+    deadline = time.monotonic() + args.settle
+    while time.monotonic() < deadline:
+        outbox = main.OUTBOX.stats()
+        if not outbox["queued"] and not outbox["in_flight"]:
+            break
+        time.sleep(0.05)
+
+    latencies = sorted(finished[i] - submitted[i] for i in finished if i in submitted)
+    webhook_latencies.sort()
+    with stub_state.lock:
+        calls = {method: count - calls_before.get(method, 0) for method, count in stub_state.calls.items()
+                 if count - calls_before.get(method, 0)}
+    result = {
+        "db_size": args.db_size,
+        "limits": args.limits,
+        "seed_s": round(seed_seconds, 2),
+        "updates": len(updates),
+        "processed": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "webhook_p99_ms": round(percentile(webhook_latencies, 0.99) * 1000, 1),
+        "statuses": statuses,
+        "outbound": calls,
+        "outbound_429": stub_state.throttled,
+        "mix": {kind: kinds.count(kind) for kind in set(kinds)},
+    }
+    print("RESULT " + json.dumps(result, ensure_ascii=False), flush=True)
+    server.shutdown()
+    stub.shutdown()
+    shutil.rmtree(work, ignore_errors=True)
+    # 广播等后台线程可能仍在运行，直接退出
+    os._exit(0)
+
+
+# --- 主进程：依次运行各个规模并汇总 ---
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8, help="并发发送 webhook 的客户端数")
+    parser.add_argument("--rate", type=float, default=0, help="每秒发送的 update 数，0 表示尽快发送（测吞吐上限）")
+    parser.add_argument("--stub-latency-ms", type=float, default=20, help="假 API 每次请求的平均延迟")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="假 API 返回 429 的概率")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--limits", choices=["production", "relaxed", "both"], default="production",
+                        help="production：main.py 默认的出站限流和防刷；relaxed：放开限流；both：两种都跑")
+    parser.add_argument("--broadcasts", type=int, default=1, help="混入的 /broadcast 条数")
+    parser.add_argument("--mix-new-user", type=float, default=20)
+    parser.add_argument("--mix-egg-hit", type=float, default=30)
+    parser.add_argument("--mix-fuzzy-miss", type=float, default=30)
+    parser.add_argument("--mix-admin-reply", type=float, default=10)
+    parser.add_argument("--mix-callback", type=float, default=10)
+    parser.add_argument("--timeout", type=float, default=600, help="等待处理完成的最长时间")
+    parser.add_argument("--settle", type=float, default=30, help="等待发件箱发完的最长时间")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--db-size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    passthrough = list(sys.argv[1:])
+    for option in ("--db-sizes", "--limits"):
+        if option in passthrough:
+            start = passthrough.index(option)
+            end = start + 1
+            while end < len(passthrough) and not passthrough[end].startswith("--"):
+                end += 1
+            del passthrough[start:end]
+    configs = ["production", "relaxed"] if args.limits == "both" else [args.limits]
+
+    print(f"{'db_size':>8}  {'limits':>10}  {'seed_s':>6}  {'upd/s':>7}  {'p50ms':>7}  {'p95ms':>7}  {'p99ms':>7}  "
+          f"{'hook99':>6}  {'429':>4}  出站调用")
+    ok = True
+    for db_size in args.db_sizes:
+        for limits in configs:
+            command = [sys.executable, os.path.abspath(__file__), "--child", "--db-size", str(db_size),
+                       "--limits", limits] + passthrough
+            proc = subprocess.run(command, capture_output=True, text=True)
+            lines = [line for line in proc.stdout.splitlines() if line.startswith("RESULT ")]
+            if proc.returncode != 0 or not lines:
+                ok = False
+                print(f"{db_size:>8}  {limits:>10}  失败 (退出码 {proc.returncode})")
+                sys.stderr.write(proc.stderr[-4000:])
+                continue
+            r = json.loads(lines[-1][len("RESULT "):])
+            calls = " ".join(f"{method}={count}" for method, count in sorted(r["outbound"].items()))
+            print(f"{r['db_size']:>8}  {limits:>10}  {r['seed_s']:>6}  {r['throughput']:>7}  {r['p50_ms']:>7}  "
+                  f"{r['p95_ms']:>7}  {r['p99_ms']:>7}  {r['webhook_p99_ms']:>6}  {r['outbound_429']:>4}  {calls}")
+            if r["processed"] < r["updates"]:
+                ok = False
+                print(f"{'':>8}  只处理了 {r['processed']}/{r['updates']} 个 update，状态码 {r['statuses']}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
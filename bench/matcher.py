@@ -0,0 +1,267 @@
+"""
+关键词匹配微基准：以 keywords.json 为基础生成 255 ~ 100k 个关键词的合成词库和中英文混合、长短不一的查询，
+对比彩蛋匹配（process_egg_keywords）和模糊匹配（semantic_match）各实现的 ns/op、每次调用的内存峰值，
+并以最初的逐个关键词遍历实现为准校验命中结果（命中哪个 egg）是否完全一致。
+
+匹配器的任何优化都应该在这里证明自己更快且结果不变；新实现可以通过 --candidate 接入，不用改本脚本：
+    --candidate egg=mymodule:build        build(eggs) 返回 match(text) -> egg 下标或 None
+    --candidate semantic=mymodule:build   build(eggs) 返回 match(joined, threshold) -> egg 下标或 None
+text 为原始文本，joined 为 jieba 分词后用空格拼接并转小写的文本。
+
+用法:
+    python bench/matcher.py
+    python bench/matcher.py --sizes 255 1000 10000 --queries 500
+    python bench/matcher.py --candidate egg=mymatcher:build
+"""
+import argparse
+import gc
+import importlib
+import json
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import jieba  # noqa: E402
+from rapidfuzz import fuzz  # noqa: E402
+
+from matcher import FuzzyIndex, build_egg_automaton  # noqa: E402
+
+COMMON_CHARS = ("的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面"
+                "而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好"
+                "应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命"
+                "此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老"
+                "头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即"
+                "保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场")
+FILLER_WORDS = ["please", "help", "order", "account", "the", "my", "is", "not", "working", "today", "thanks",
+                "refund", "where", "when", "price", "shipping", "login", "error", "app", "bot"]
+
+
+# --- 合成数据 ---
+def synthetic_keyword(rng):
+    if rng.random() < 0.6:
+        return "".join(rng.choice(COMMON_CHARS) for _ in range(rng.randint(2, 5)))
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10)))
+
+
+def build_keywords(base, size, rng):
+    """在 base 的 egg 之后追加合成 egg（每个 20 个关键词），凑满 size 个关键词；size 小于 base 时按顺序截取"""
+    eggs = []
+    total = 0
+    for egg in base["eggs"]:
+        keywords = egg["keywords"][:max(0, size - total)]
+        if not keywords:
+            break
+        eggs.append(dict(egg, keywords=keywords))
+        total += len(keywords)
+    seen = {k.lower() for egg in eggs for k in egg["keywords"]}
+    while total < size:
+        keywords = []
+        while len(keywords) < min(20, size - total):
+            keyword = synthetic_keyword(rng)
+            if keyword not in seen:
+                seen.add(keyword)
+                keywords.append(keyword)
+        eggs.append({"intent": f"synthetic_{len(eggs)}", "keywords": keywords, "reply": f"合成回复 {len(eggs)}"})
+        total += len(keywords)
+    return {"eggs": eggs, "prizes": base.get("prizes", [])}
+
+
+def filler(rng, length):
+    parts = []
+    while sum(len(p) for p in parts) < length:
+        if rng.random() < 0.7:
+            parts.append("".join(rng.choice(COMMON_CHARS) for _ in range(rng.randint(1, 6))))
+        else:
+            parts.append(" " + rng.choice(FILLER_WORDS) + " ")
+    return "".join(parts)[:length]
+
+
+def mutate(rng, keyword):
+    """替换或插入一个字符，制造需要模糊匹配才能命中的近似词"""
+    pos = rng.randrange(len(keyword))
+    ch = rng.choice(COMMON_CHARS if ord(keyword[pos]) > 127 else string.ascii_lowercase)
+    if rng.random() < 0.5:
+        return keyword[:pos] + ch + keyword[pos + 1:]
+    return keyword[:pos] + ch + keyword[pos:]
+
+
+def build_queries(keyword_data, count, rng):
+    keywords = [k for egg in keyword_data["eggs"] for k in egg["keywords"] if k]
+    queries = []
+    for _ in range(count):
+        length = rng.choice([rng.randint(2, 6), rng.randint(10, 30), rng.randint(50, 200)])
+        kind = rng.random()
+        if kind < 0.35:
+            keyword = rng.choice(keywords)
+            text = filler(rng, length // 2) + keyword + filler(rng, length // 2)
+        elif kind < 0.65:
+            keyword = mutate(rng, rng.choice(keywords))
+            text = filler(rng, length // 2) + keyword + filler(rng, length // 2)
+        else:
+            text = filler(rng, length)
+        if rng.random() < 0.3:
+            text = text.upper()
+        queries.append(text)
+    return queries
+
+
+# --- 实现 ---
+def naive_egg(eggs):
+    """最初 process_egg_keywords 的匹配部分：逐个 egg、逐个关键词做子串查找"""
+    def match(text):
+        lowered = text.lower()
+        for index, egg in enumerate(eggs):
+            for keyword in egg["keywords"]:
+                if keyword.lower() in lowered:
+                    return index
+        return None
+    return match
+
+
+def naive_semantic(eggs):
+    """最初 semantic_match 的匹配部分：对每个关键词算 partial_ratio，取严格更高分的第一个"""
+    def match(joined, threshold):
+        best_score, best_index = 0, None
+        for index, egg in enumerate(eggs):
+            for keyword in egg["keywords"]:
+                score = fuzz.partial_ratio(joined, keyword.lower())
+                if score > best_score:
+                    best_score, best_index = score, index
+        return best_index if best_score >= threshold else None
+    return match
+
+
+def automaton_egg(eggs):
+    automaton = build_egg_automaton(eggs)
+    return lambda text: automaton.match(text.lower())
+
+
+def fuzzy_index_semantic(eggs):
+    return FuzzyIndex(eggs).best
+
+
+IMPLEMENTATIONS = {
+    "egg": {"naive": naive_egg, "automaton": automaton_egg},
+    "semantic": {"naive": naive_semantic, "fuzzy_index": fuzzy_index_semantic},
+}
+ORACLE = "naive"
+
+
+def load_candidate(spec):
+    stage, _, target = spec.partition("=")
+    module_name, _, attr = target.partition(":")
+    if stage not in IMPLEMENTATIONS or not module_name or not attr:
+        raise SystemExit(f"--candidate 格式应为 egg=模块:函数 或 semantic=模块:函数，收到 {spec}")
+    if os.getcwd() not in sys.path:
+        sys.path.append(os.getcwd())
+    IMPLEMENTATIONS[stage][f"{module_name}:{attr}"] = getattr(importlib.import_module(module_name), attr)
+
+
+# --- 测量 ---
+def measure(fn, inputs, repeat, budget):
+    """返回 (ns/op, 结果列表)；每轮跑完全部输入，取最快的一轮，超过 budget 秒就不再重复"""
+    results = [fn(*args) for args in inputs]
+    best = None
+    spent = 0.0
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter_ns()
+        for args in inputs:
+            fn(*args)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+        spent += elapsed / 1e9
+        if spent > budget:
+            break
+    return best / len(inputs), results
+
+
+def measure_memory(fn, inputs):
+    """每次调用相对调用前的内存峰值（字节），取平均；与计时分开测，tracemalloc 本身开销很大"""
+    total = 0
+    tracemalloc.start()
+    try:
+        for args in inputs:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fn(*args)
+            total += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return total / len(inputs)
+
+
+def run_size(size, base, args):
+    rng = random.Random(args.seed + size)
+    keyword_data = build_keywords(base, size, rng)
+    eggs = keyword_data["eggs"]
+    queries = build_queries(keyword_data, args.queries, rng)
+
+    start = time.perf_counter_ns()
+    joined = [" ".join(jieba.cut_for_search(q)).lower() for q in queries]
+    jieba_ns = (time.perf_counter_ns() - start) / len(queries)
+
+    inputs = {"egg": [(q,) for q in queries], "semantic": [(j, args.threshold) for j in joined]}
+    rows = []
+    ok = True
+    for stage, impls in IMPLEMENTATIONS.items():
+        oracle = None
+        for name, build in impls.items():
+            start = time.perf_counter()
+            fn = build(eggs)
+            build_ms = (time.perf_counter() - start) * 1000
+            ns, results = measure(fn, inputs[stage], args.repeat, args.budget)
+            memory = measure_memory(fn, inputs[stage][:args.memory_queries])
+            if name == ORACLE:
+                oracle = results
+            mismatches = [i for i, (a, b) in enumerate(zip(oracle, results)) if a != b] if oracle else []
+            if mismatches:
+                ok = False
+                for i in mismatches[:args.show_mismatches]:
+                    print(f"  不一致 [{stage}/{name}] {queries[i]!r}: 期望 {oracle[i]}，得到 {results[i]}")
+            hits = sum(r is not None for r in results)
+            rows.append((size, stage, name, build_ms, ns, memory, hits / len(results), len(mismatches)))
+    return rows, jieba_ns, ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[255, 1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--threshold", type=float, default=80, help="与 SEMANTIC_THRESHOLD 一致")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=10, help="每个实现重复计时的最长秒数")
+    parser.add_argument("--memory-queries", type=int, default=50, help="测内存峰值时使用的查询数")
+    parser.add_argument("--show-mismatches", type=int, default=5)
+    parser.add_argument("--candidate", action="append", default=[], help="stage=模块:函数，可重复")
+    parser.add_argument("--keywords", default=os.path.join(ROOT, "keywords.json"))
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    for spec in args.candidate:
+        load_candidate(spec)
+    with open(args.keywords, "r", encoding="utf-8") as f:
+        base = json.load(f)
+    jieba.setLogLevel(60)
+    jieba.initialize()
+
+    ok = True
+    print(f"{'关键词':>7}  {'阶段':<8}  {'实现':<14}  {'建索引ms':>8}  {'ns/op':>12}  {'峰值B/op':>9}  {'命中率':>6}  不一致")
+    for size in args.sizes:
+        rows, jieba_ns, size_ok = run_size(size, base, args)
+        ok = ok and size_ok
+        for size_, stage, name, build_ms, ns, memory, hit_rate, mismatches in rows:
+            print(f"{size_:>7}  {stage:<8}  {name:<14}  {build_ms:>8.1f}  {ns:>12,.0f}  {memory:>9,.0f}  "
+                  f"{hit_rate:>6.1%}  {mismatches}")
+        print(f"{size:>7}  {'jieba':<8}  {'cut_for_search':<14}  {'':>8}  {jieba_ns:>12,.0f}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
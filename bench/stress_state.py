@@ -0,0 +1,103 @@
+"""
+状态存储并发压测：多个进程 × 多个线程同时读写同一份存储，结束后校验计数是否严格一致。
+
+用法:
+    python bench/stress_state.py                      # json 后端（多进程模式 shared=True）
+    python bench/stress_state.py --backend sqlite
+    python bench/stress_state.py --processes 4 --threads 8 --ops 500
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import JsonStore, SqliteStore, StatCounters  # noqa: E402
+
+
+def open_store(backend, path, compact_threshold):
+    if backend == "sqlite":
+        return SqliteStore(path)
+    return JsonStore(path, compact_threshold=compact_threshold, shared=True)
+
+
+def run_process(args, path):
+    store = open_store(args.backend, path, args.compact_threshold)
+    counters = StatCounters(store, flush_interval=0.05)
+
+    def run_thread(tid):
+        for i in range(args.ops):
+            uid = str((os.getpid() * 31 + tid * 7 + i) % args.users)
+            store.add("users", uid, {"username": f"u{uid}", "first_seen": int(time.time()), "messages_count": 0})
+            store.update("users", uid, lambda u: dict(u, messages_count=u["messages_count"] + 1))
+            store.incr("stats", "messages_received")
+            counters.incr("egg_hits")
+            key = f"{os.getpid()}_{tid}_{i}"
+            store.put("pending_actions", key, {"type": "reply", "target_id": uid})
+            if store.pop("pending_actions", key) is None:
+                raise AssertionError(f"pending action {key} 丢失")
+
+    threads = [threading.Thread(target=run_thread, args=(t,)) for t in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    counters.flush()
+    store.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--ops", type=int, default=300, help="每个线程的操作轮数")
+    parser.add_argument("--users", type=int, default=50, help="参与竞争的用户数，越小冲突越多")
+    parser.add_argument("--compact-threshold", type=int, default=500, help="json 后端压缩阈值，调小可覆盖压缩时的切换")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="stress-state-")
+    path = os.path.join(workdir, "database.db" if args.backend == "sqlite" else "database.json")
+    open_store(args.backend, path, args.compact_threshold).flush()
+
+    start = time.perf_counter()
+    procs = [multiprocessing.Process(target=run_process, args=(args, path)) for _ in range(args.processes)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - start
+
+    if any(p.exitcode != 0 for p in procs):
+        print("❌ 有工作进程异常退出")
+        sys.exit(1)
+
+    store = open_store(args.backend, path, args.compact_threshold)
+    expected = args.processes * args.threads * args.ops
+    stats = dict(store.items("stats"))
+    messages_total = sum(u["messages_count"] for _, u in store.items("users"))
+    checks = {
+        "stats.messages_received": stats.get("messages_received", 0),
+        "stats.egg_hits": stats.get("egg_hits", 0),
+        "sum(users.messages_count)": messages_total,
+    }
+
+    ok = True
+    for name, value in checks.items():
+        mark = "✅" if value == expected else "❌"
+        ok = ok and value == expected
+        print(f"{mark} {name} = {value}（期望 {expected}）")
+    pending_left = store.count("pending_actions")
+    print(f"{'✅' if pending_left == 0 else '❌'} 残留 pending_actions = {pending_left}")
+    ok = ok and pending_left == 0
+    print(f"后端 {args.backend}，{args.processes} 进程 × {args.threads} 线程，"
+          f"{expected * 5} 次存储操作，耗时 {elapsed:.2f}s（{expected * 5 / elapsed:.0f} ops/s）")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from ratelimit import TokenBucket
+
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 fcntl，只能单进程使用
+    fcntl = None
+
+# 这两类失败说明用户已经无法接收消息，单独统计
+UNREACHABLE_ERRORS = ("user_blocked", "chat_not_found")
+
+
+class BroadcastManager:
+    """
+    后台广播任务。
+
+    目标用户按 ID 排序后分批发送，批内由 concurrency 个线程并发、共用一个令牌桶限速（rate 条/秒）。
+    每批完成后把游标（本批最大的用户ID）和计数写入检查点文件，进程重启后调用 resume()
+    从游标之后继续，最多重复发送崩溃时正在进行的那一批。
+
+    多进程部署时各进程共用检查点：任务运行期间持有 path + ".lock" 的 flock，同一时间只有一个进程在广播，
+    其他进程的 current() 读取检查点。resume() 可以反复调用（如每个 webhook 请求），至多每 resume_interval
+    秒尝试一次，执行任务的进程退出后由下一个调用的进程接手。
+
+    send(chat_id, text) 返回 send_message 格式的结果；targets() 返回当前的广播对象；
+    notify(job, finished) 用于向管理员汇报进度，返回进度消息的 message_id（可为 None）。
+    """
+
+    def __init__(self, path, send, targets, notify, rate=25, concurrency=8, batch_size=100, progress_interval=5,
+                 resume_interval=30):
+        self.path = path
+        self.send = send
+        self.targets = targets
+        self.notify = notify
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.resume_interval = resume_interval
+        self._lock = threading.Lock()
+        self._job = None
+        self._lock_file = None
+        self._next_resume = 0
+
+    # --- 检查点 ---
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _save(self, job):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def _acquire(self):
+        """尝试获得广播的跨进程锁，已被其他进程持有时返回 False"""
+        if fcntl is None:
+            return True
+        lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _release(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _running(self):
+        return self._job is not None and self._job["status"] == "running"
+
+    # --- 对外接口 ---
+    def current(self):
+        """本进程的任务；本进程没有运行中的任务时以检查点为准（可能是其他进程正在执行的任务）"""
+        with self._lock:
+            if self._running():
+                return dict(self._job)
+        return self._load() or (dict(self._job) if self._job else None)
+
+    def start(self, text):
+        """创建并启动广播任务；已有任务在运行（包括其他进程中、或检查点里未完成的任务）时返回 None"""
+        with self._lock:
+            if self._running() or not self._acquire():
+                return None
+            previous = self._load()
+            if previous and previous.get("status") == "running":
+                # 上一个执行它的进程已退出，先把它发完
+                self._job = previous
+                self._resume(previous)
+                return None
+            job = {
+                "id": uuid.uuid4().hex[:8],
+                "text": text,
+                "status": "running",
+                "created_at": int(time.time()),
+                "cursor": None,
+                "total": len(self.targets()),
+                "done": 0,
+                "sent": 0,
+                "failed": 0,
+                "unreachable": 0,
+                "progress_message_id": None,
+            }
+            self._job = job
+        try:
+            job["progress_message_id"] = self.notify(dict(job), False)
+            self._save(job)
+        except Exception:
+            # 任务没能开始，放开锁，否则之后所有进程都无法再发起广播
+            with self._lock:
+                self._job = None
+                self._release()
+            raise
+        threading.Thread(target=self._run, args=(job,), name=f"broadcast-{job['id']}", daemon=True).start()
+        return dict(job)
+
+    def resume(self):
+        """检查点里有未完成、且没有其他进程在执行的任务就从游标处继续"""
+        now = time.monotonic()
+        with self._lock:
+            if self._running() or now < self._next_resume:
+                return None
+            self._next_resume = now + self.resume_interval
+            if not self._acquire():
+                return None
+            job = self._load()
+            if not job or job.get("status") != "running":
+                self._release()
+                return None
+            self._job = job
+            self._resume(job)
+        return dict(job)
+
+    def _resume(self, job):
+        logging.info(f"继续未完成的广播 {job['id']}，已处理 {job['done']}/{job['total']}")
+        threading.Thread(target=self._run, args=(job,), name=f"broadcast-{job['id']}", daemon=True).start()
+
+    # --- 发送 ---
+    def _send_one(self, chat_id, text):
+        self.bucket.acquire()
+        try:
+            return self.send(chat_id, text)
+        except Exception as e:
+            logging.error(f"广播到 {chat_id} 失败: {e}")
+            return {"status": "error", "error": "exception", "description": str(e)}
+
+    def _run(self, job):
+        cursor = job["cursor"]
+        remaining = sorted(int(uid) for uid in self.targets())
+        if cursor is not None:
+            remaining = [uid for uid in remaining if uid > cursor]
+        last_report = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f"broadcast-{job['id']}") as pool:
+            for start in range(0, len(remaining), self.batch_size):
+                batch = remaining[start:start + self.batch_size]
+                results = list(pool.map(lambda uid: self._send_one(uid, job["text"]), batch))
+                with self._lock:
+                    for result in results:
+                        if result.get("status") == "success":
+                            job["sent"] += 1
+                        else:
+                            job["failed"] += 1
+                            if result.get("error") in UNREACHABLE_ERRORS:
+                                job["unreachable"] += 1
+                    job["done"] += len(batch)
+                    job["cursor"] = batch[-1]
+                    # 广播过程中新增的用户也会被发送，总数随之更新
+                    job["total"] = max(job["total"], job["done"])
+                self._save(job)
+                if time.monotonic() - last_report >= self.progress_interval:
+                    self._report(job, False)
+                    last_report = time.monotonic()
+
+        with self._lock:
+            job["status"] = "done"
+            job["finished_at"] = int(time.time())
+            self._save(job)
+            self._release()
+        logging.info(f"广播 {job['id']} 完成：成功 {job['sent']}，失败 {job['failed']}")
+        self._report(job, True)
+
+    def _report(self, job, finished):
+        try:
+            message_id = self.notify(dict(job), finished)
+            if message_id and not job["progress_message_id"]:
+                job["progress_message_id"] = message_id
+        except Exception as e:
+            logging.warning(f"汇报广播进度失败：{e}")
@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class UpdateDispatcher:
+    """
+    Webhook 收到的 update 先放进有界队列并立即返回，由固定数量的工作线程取出交给 handler 处理。
+    队列满时 submit() 返回 False，由调用方决定如何拒绝（让 Telegram 稍后重发）。
+
+    每个工作线程有自己的队列（lane），key(update) 相同的 update（同一个用户）总是进入同一条 lane，
+    因此同一用户的消息严格按到达顺序逐条处理，不同用户之间并行。
+    """
+
+    def __init__(self, handler, workers=4, maxsize=1000, latency_window=1000, key=None):
+        self.handler = handler
+        self.workers = workers
+        self.key = key
+        # 总容量平均分给各条 lane
+        self._lanes = [queue.Queue(max(1, -(-maxsize // workers))) for _ in range(workers)]
+        self._lock = threading.Lock()
+        self._all_done = threading.Condition(self._lock)
+        self._unfinished = 0
+        self._next_lane = 0
+        self._threads = []
+        # 最近 latency_window 个 update 从入队到处理完成的耗时（秒）
+        self._latencies = deque(maxlen=latency_window)
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i, lane in enumerate(self._lanes):
+                thread = threading.Thread(target=self._worker, args=(lane,), name=f"update-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _lane(self, update):
+        key = self.key(update) if self.key else None
+        if key is None:
+            # 没有用户的 update 不需要保序，轮流分配
+            with self._lock:
+                self._next_lane = (self._next_lane + 1) % self.workers
+                return self._lanes[self._next_lane]
+        return self._lanes[hash(key) % self.workers]
+
+    def submit(self, update):
+        if not self._threads:
+            self.start()
+        lane = self._lane(update)
+        with self._lock:
+            self._unfinished += 1
+        try:
+            lane.put_nowait((time.monotonic(), update))
+            return True
+        except queue.Full:
+            with self._lock:
+                self._unfinished -= 1
+                self.rejected += 1
+                self._all_done.notify_all()
+            return False
+
+    def _worker(self, lane):
+        while True:
+            enqueued_at, update = lane.get()
+            failed = False
+            try:
+                self.handler(update)
+            except Exception:
+                failed = True
+                logging.exception(f"处理 update {update.get('update_id')} 失败")
+            finally:
+                latency = time.monotonic() - enqueued_at
+                with self._lock:
+                    self.processed += 1
+                    self.failed += failed
+                    self._latencies.append(latency)
+                    self._unfinished -= 1
+                    if not self._unfinished:
+                        self._all_done.notify_all()
+
+    def drain(self, timeout=10):
+        """等待已接收的 update 处理完，超时返回 False"""
+        if not self._threads:
+            return True
+        deadline = time.monotonic() + timeout
+        with self._all_done:
+            while self._unfinished:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logging.warning(f"仍有 {self._unfinished} 个 update 未处理完")
+                    return False
+                self._all_done.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            result = {
+                "queue_depth": sum(lane.qsize() for lane in self._lanes),
+                "workers": self.workers,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+        if latencies:
+            result["latency_avg_ms"] = round(sum(latencies) / len(latencies) * 1000, 1)
+            result["latency_p95_ms"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+            result["latency_max_ms"] = round(latencies[-1] * 1000, 1)
+        return result
+
+
+class UpdateDeduplicator:
+    """
+    按 update_id 去重：Telegram 在 webhook 响应慢时会重发同一个 update。
+    记住最近 window 个 update_id；被挤出窗口的 id 中最大的一个作为下限，不大于下限的一律视为重复。
+    传入 path 时，正常退出时保存窗口，启动时读回。
+    """
+
+    def __init__(self, window=10000, path=None):
+        self.window = window
+        self.path = path
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+        self._floor = None
+        self.suppressed = 0
+        if path:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        self._floor = state.get("floor")
+        for update_id in state.get("seen", [])[-self.window:]:
+            self._seen[update_id] = None
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            state = {"floor": self._floor, "seen": list(self._seen)}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def seen(self, update_id):
+        """已经见过返回 True（并计入 suppressed），否则记下并返回 False"""
+        with self._lock:
+            if update_id in self._seen or (self._floor is not None and update_id <= self._floor):
+                self.suppressed += 1
+                return True
+            self._seen[update_id] = None
+            if len(self._seen) > self.window:
+                oldest, _ = self._seen.popitem(last=False)
+                if self._floor is None or oldest > self._floor:
+                    self._floor = oldest
+            return False
+
+    def forget(self, update_id):
+        """update 没能入队时调用，让 Telegram 重发的同一个 update 可以再次被接收"""
+        with self._lock:
+            self._seen.pop(update_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"window": len(self._seen), "floor": self._floor, "suppressed": self.suppressed}
@@ -0,0 +1,99 @@
+import logging
+import threading
+import time
+
+
+class ForwardCoalescer:
+    """
+    把同一用户短时间内的多条留言合并进一条转发消息，减少发往管理员会话的请求。
+
+    用户的第一条留言立即 send() 出去；之后 window 秒内的留言只追加到缓冲区，
+    由后台线程每 edit_interval 秒把有变化的转发消息 edit() 一次，多条留言合并成一次编辑。
+    超过 window 秒，或追加后会超过 max_length（Telegram 单条消息上限 4096 字符）时，另起一条新的转发。
+
+    send(user_id, text) 返回转发消息的 message_id（失败为 None）；edit(user_id, message_id, text) 原地更新。
+    """
+
+    def __init__(self, send, edit, window=10, edit_interval=1.0, max_length=4096):
+        self.send = send
+        self.edit = edit
+        self.window = window
+        self.edit_interval = edit_interval
+        self.max_length = max_length
+        self._lock = threading.Lock()
+        # user_id -> {"message_id", "header", "texts", "started", "dirty"}
+        self._open = {}
+        # 被新转发替换、但还有留言没编辑进去的旧条目，也交给后台线程处理，保证同一条消息的编辑不会乱序
+        self._retired = []
+        self._flusher = None
+        self.sent = 0
+        self.merged = 0
+        self.edits = 0
+
+    @staticmethod
+    def render(header, texts):
+        return header + "\n\n".join(texts)
+
+    def add(self, user_id, header, text):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._open.get(user_id)
+            if (entry is not None and now - entry["started"] <= self.window
+                    and len(self.render(header, entry["texts"] + [text])) <= self.max_length):
+                entry["texts"].append(text)
+                entry["header"] = header
+                entry["dirty"] = True
+                self.merged += 1
+                self._start_flusher()
+                return
+
+        # 新开一条转发；同一用户的消息在同一条 lane 里按顺序处理，这里不会与该用户的其他 add() 并发
+        message_id = self.send(user_id, self.render(header, [text]))
+        with self._lock:
+            self.sent += 1
+            if message_id is None:
+                self._open.pop(user_id, None)
+                return
+            old = self._open.get(user_id)
+            if old is not None and old["dirty"]:
+                self._retired.append((user_id, old))
+            self._open[user_id] = {"message_id": message_id, "header": header, "texts": [text],
+                                   "started": now, "dirty": False}
+
+    def _edit(self, user_id, entry):
+        try:
+            self.edit(user_id, entry["message_id"], self.render(entry["header"], entry["texts"]))
+            with self._lock:
+                self.edits += 1
+        except Exception as e:
+            logging.error(f"更新用户 {user_id} 的合并转发失败: {e}")
+
+    def flush(self):
+        """把所有缓冲中的留言编辑进转发消息，并清理已过期的合并窗口；只应由后台线程或退出时调用"""
+        now = time.monotonic()
+        with self._lock:
+            pending, self._retired = self._retired, []
+            for user_id, entry in list(self._open.items()):
+                if entry["dirty"]:
+                    entry["dirty"] = False
+                    # 复制一份，避免编辑期间被 add() 修改
+                    pending.append((user_id, dict(entry, texts=list(entry["texts"]))))
+                elif now - entry["started"] > self.window:
+                    del self._open[user_id]
+        for user_id, entry in pending:
+            self._edit(user_id, entry)
+
+    def _start_flusher(self):
+        # 调用方需持有 self._lock
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run, name="forward-flusher", daemon=True)
+            self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.edit_interval)
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {"open": len(self._open), "sent": self.sent, "merged": self.merged, "edits": self.edits}
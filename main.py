@@ -1,6 +1,7 @@
-from flask import Flask, request
-import requests
+from flask import Flask, request, jsonify
 import json
+import copy
+import html
 from config import TOKEN, ADMIN_ID
 import os
 import re
@@ -8,13 +9,30 @@ import time
 import random
 from datetime import datetime
 import logging
+import atexit
+import signal
+import sys
+import threading
 import jieba
-from rapidfuzz import fuzz
+from storage import JsonStore, SqliteStore, StatCounters, PendingActions
+from matcher import KeywordCache
+from telegram_api import TelegramClient
+from dispatch import UpdateDispatcher, UpdateDeduplicator
+from broadcast import BroadcastManager
+from ratelimit import OutboundLimiter, FloodGuard
+from polling import UpdatePoller
+from forwarding import ForwardCoalescer
+from outbox import Outbox
+from metrics import REGISTRY, Counter, Histogram, Gauge
+from tracing import Tracer
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+STARTUP_BEGIN = time.perf_counter()
 
 app = Flask(__name__)
-BOT_URL = f"https://api.telegram.org/bot{TOKEN}"
+# 可通过 TELEGRAM_API_BASE 指向本地的 Bot API 服务器或测试桩
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org")
+BOT_URL = f"{TELEGRAM_API_BASE}/bot{TOKEN}"
 DB_FILE = "database.json"
 KEYWORD_FILE = "keywords.json"
 WELCOME_MSG = """👋 欢迎使用智能客服机器人！
@@ -25,40 +43,107 @@ WELCOME_MSG = """👋 欢迎使用智能客服机器人！
 - 试试触发隐藏彩蛋吧！"""
 
 
+# --- 监控指标 ---
+# 由 /metrics 按 Prometheus 文本格式导出；每次记录只是一次加锁和二分查找，可以在生产环境常开
+WEBHOOK_REQUESTS = Counter("bot_webhook_requests_total", "webhook 请求数，按处理结果分类", ["result"])
+WEBHOOK_SECONDS = Histogram("bot_webhook_seconds", "webhook 请求的处理耗时（只含校验和入队）")
+UPDATE_SECONDS = Histogram("bot_update_seconds", "单个 update 在工作线程中的处理耗时", ["type"])
+STAGE_SECONDS = Histogram("bot_stage_seconds", "各处理阶段的耗时", ["stage"])
+STORE_SECONDS = Histogram("bot_store_seconds", "存储操作耗时：读写接口按方法名，json 后端的后台落盘按 flush、"
+                          "journal_append、snapshot 等", ["op"])
+TELEGRAM_REQUESTS = Counter("bot_telegram_requests_total",
+                            "Bot API 请求数，按方法和结果分类；throttled 为本地限流拒绝、没有发出的请求", ["method", "outcome"])
+TELEGRAM_SECONDS = Histogram("bot_telegram_request_seconds", "实际发出的 Bot API 请求耗时（含出站限流等待）", ["method"])
+
+TELEGRAM_OUTCOMES = {"too_many_requests": "429", "user_blocked": "blocked", "chat_not_found": "chat_not_found",
+                     "no_response": "no_response", "server_error": "server_error"}
+
+
+def observe_telegram(method, result, seconds):
+    if result["status"] == "success":
+        outcome = "success"
+    elif result.get("throttled"):
+        # 本地限流拒绝、没有发出去的请求单独计数，429 只统计 Telegram 真正返回的
+        outcome = "throttled"
+    else:
+        outcome = TELEGRAM_OUTCOMES.get(result.get("error"), "error")
+    TELEGRAM_REQUESTS.inc(method=method, outcome=outcome)
+    if outcome != "throttled":
+        TELEGRAM_SECONDS.observe(seconds, method=method)
+    TRACER.record(f"telegram.{method}", seconds, outcome=outcome)
+
+
+# --- 请求追踪 ---
+# TRACE_SAMPLE_RATE 为 0（默认）时关闭；抽中的 update 耗时超过 TRACE_SLOW_MS 毫秒时，调用树写入 TRACE_FILE
+# TRACE_PROFILE=1 时同时附上 cProfile 统计（同一时间只分析一个 update，开销较大，建议配合较低的抽样率）
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0))
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", 1000))
+TRACE_FILE = os.environ.get("TRACE_FILE", "slow_updates.log")
+TRACE_MAX_BYTES = int(os.environ.get("TRACE_MAX_BYTES", 10 * 1024 * 1024))
+TRACE_BACKUP_COUNT = int(os.environ.get("TRACE_BACKUP_COUNT", 3))
+TRACE_PROFILE = os.environ.get("TRACE_PROFILE", "0") == "1"
+TRACER = Tracer(sample_rate=TRACE_SAMPLE_RATE, slow_threshold=TRACE_SLOW_MS / 1000, path=TRACE_FILE,
+                max_bytes=TRACE_MAX_BYTES, backup_count=TRACE_BACKUP_COUNT, profile=TRACE_PROFILE)
+
+
 # --- 数据管理 ---
+# DB_BACKEND=json（默认）：数据常驻内存，每次修改只追加一条日志记录，由后台线程批量落盘并定期压缩成快照
+# DB_BACKEND=sqlite：使用 SQLITE_FILE，可先用 `python storage.py migrate` 从 database.json 迁移
+# 多进程部署（如 gunicorn -w N）时，json 后端需设置 DB_SHARED=1，通过文件锁和日志在进程间同步；sqlite 后端天然支持
+DB_BACKEND = os.environ.get("DB_BACKEND", "json")
+SQLITE_FILE = os.environ.get("SQLITE_FILE", "database.db")
+DB_FLUSH_INTERVAL = float(os.environ.get("DB_FLUSH_INTERVAL", 2))
+DB_FLUSH_THRESHOLD = int(os.environ.get("DB_FLUSH_THRESHOLD", 100))
+DB_COMPACT_THRESHOLD = int(os.environ.get("DB_COMPACT_THRESHOLD", 10000))
+DB_FSYNC = os.environ.get("DB_FSYNC", "0") == "1"
+DB_SHARED = os.environ.get("DB_SHARED", "0") == "1"
+if DB_BACKEND == "sqlite":
+    STORE = SqliteStore(SQLITE_FILE)
+else:
+    STORE = JsonStore(DB_FILE, flush_interval=DB_FLUSH_INTERVAL, flush_threshold=DB_FLUSH_THRESHOLD,
+                      compact_threshold=DB_COMPACT_THRESHOLD, fsync=DB_FSYNC, shared=DB_SHARED,
+                      observer=lambda op, seconds: STORE_SECONDS.observe(seconds, op=op))
+# 每次读写（sqlite 后端即每次查询）计入 bot_store_seconds；开启追踪时同时记录为 store.<方法名> 的 span
+STORE_METHODS = ["load", "save", "get", "put", "add", "update", "pop", "incr", "count", "keys", "items",
+                 "blacklist_page", "broadcast_targets"]
+STORE = TRACER.wrap(STORE_SECONDS.wrap(STORE, STORE_METHODS, "op"), STORE_METHODS, "store")
+atexit.register(STORE.flush)
+
+# 计数类统计先在内存中聚合，定期合并进 stats
+STATS_FLUSH_INTERVAL = float(os.environ.get("STATS_FLUSH_INTERVAL", 5))
+COUNTERS = StatCounters(STORE, flush_interval=STATS_FLUSH_INTERVAL)
+atexit.register(COUNTERS.flush)  # atexit 后注册先执行，保证增量先合并再落盘
+
+
+# 待回复操作：PENDING_TTL 秒内没有回复就过期，最多保留 PENDING_MAX 条
+# PENDING_EDIT_EXPIRED=1 时把过期的提示消息改成“已过期”，避免管理员回复后没有反应
+PENDING_TTL = float(os.environ.get("PENDING_TTL", 86400))
+PENDING_MAX = int(os.environ.get("PENDING_MAX", 1000))
+PENDING_EDIT_EXPIRED = os.environ.get("PENDING_EDIT_EXPIRED", "1") == "1"
+
+
+def expire_prompt(key, action):
+    # 申诉等以 appeal_<用户ID> 为 key 的记录没有对应的提示消息
+    if not PENDING_EDIT_EXPIRED or not key.isdigit():
+        return
+    TELEGRAM.call("editMessageText", {
+        "chat_id": ADMIN_ID,
+        "message_id": int(key),
+        "text": "⌛ 该操作已过期，请重新发起。"
+    }, wait=True)
+
+
+PENDING = PendingActions(STORE, ttl=PENDING_TTL, max_entries=PENDING_MAX, on_expire=expire_prompt)
+
+
+@TRACER.traced()
 def load_data():
-    try:
-        with open(DB_FILE, "r") as f:
-            data = json.load(f)
-            data.setdefault("users", {})
-            data.setdefault("blacklist", {})
-            data.setdefault("stats", {
-                "messages_received": 0,
-                "users_count": 0,
-                "blacklist_count": 0,
-                "replies_sent": 0,
-                "egg_hits": 0
-            })
-            data.setdefault("pending_actions", {})
-            return data
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {
-            "users": {},
-            "blacklist": {},
-            "stats": {
-                "messages_received": 0,
-                "users_count": 0,
-                "blacklist_count": 0,
-                "replies_sent": 0,
-                "egg_hits": 0
-            },
-            "pending_actions": {}
-        }
+    return STORE.load()
 
 
+@TRACER.traced()
 def save_data(data):
-    with open(DB_FILE, "w") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+    STORE.save(data)
 
 
 # --- 词库管理 ---
@@ -79,35 +164,88 @@ def load_keywords():
 
 
 def save_keywords(data):
-    with open(KEYWORD_FILE, "w", encoding="utf-8") as f:
+    # 先写临时文件再替换，避免其他线程读到写了一半的词库
+    tmp_path = KEYWORD_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, KEYWORD_FILE)
+    KEYWORDS.invalidate()
 
 
+# 词库及其匹配结构的缓存，文件变化或 save_keywords() 之后自动重建，无需重启
+KEYWORDS = KeywordCache(KEYWORD_FILE, load_keywords)
+
+# 模糊匹配阈值，建议 75～85 之间
+SEMANTIC_THRESHOLD = float(os.environ.get("SEMANTIC_THRESHOLD", 80))
+
+
+@TRACER.traced()
+@STAGE_SECONDS.timed(stage="semantic_match")
 def semantic_match(text):
     """
     对未命中的文本，按意图里的每个关键词做模糊匹配，返回得分最高且超过阈值的 egg.reply，否则返回 None。
     """
-    keywords_data = load_keywords()
-    best_score = 0
-    best_reply = None
+    keyword_set = KEYWORDS.get()
 
     # 分词，有助于长句拆分
-    tokens = list(jieba.cut_for_search(text))
+    with STAGE_SECONDS.time(stage="jieba_cut"):
+        tokens = list(jieba.cut_for_search(text))
     joined = " ".join(tokens).lower()
 
-    for egg in keywords_data.get("eggs", []):
-        for kw in egg["keywords"]:
-            # 用 partial_ratio 对拼接后的句子和单个关键词做局部匹配
-            score = fuzz.partial_ratio(joined, kw.lower())
-            if score > best_score:
-                best_score, best_reply = score, egg["reply"]
+    # 用 partial_ratio 对拼接后的句子和索引中的关键词做局部匹配
+    with STAGE_SECONDS.time(stage="fuzzy_match"):
+        index = keyword_set.fuzzy.best(joined, SEMANTIC_THRESHOLD)
+    return keyword_set.eggs[index]["reply"] if index is not None else None
+
 
-    # 阈值75～85之间
-    return best_reply if best_score >= 80 else None
+# --- 分词器预热 ---
+# jieba 默认在第一次分词时才加载词典（约 1 秒），这里在后台线程提前加载，并构建词库的匹配结构；
+# 预热完成前健康检查返回 503，负载均衡不会把流量转过来。预热期间到达的消息仍能处理，只是要等加载完成。
+# JIEBA_CACHE_DIR 指定词典缓存目录（默认系统临时目录，容器重启后会丢失），可在构建镜像时用
+# `python main.py warmup` 预先生成缓存
+JIEBA_CACHE_DIR = os.environ.get("JIEBA_CACHE_DIR", "")
+if JIEBA_CACHE_DIR:
+    os.makedirs(JIEBA_CACHE_DIR, exist_ok=True)
+    jieba.dt.tmp_dir = JIEBA_CACHE_DIR
+READY = threading.Event()
+
+
+def warm_up():
+    start = time.perf_counter()
+    try:
+        jieba.initialize()
+        jieba.lcut_for_search("预热")
+        KEYWORDS.get()
+    except Exception:
+        logging.exception("分词器预热失败，将在第一次匹配时再加载")
+    READY.set()
+    logging.info(f"分词器和词库预热完成，耗时 {time.perf_counter() - start:.2f} 秒，"
+                 f"距启动 {time.perf_counter() - STARTUP_BEGIN:.2f} 秒")
+
+
+threading.Thread(target=warm_up, name="tokenizer-warmup", daemon=True).start()
 
 
 # --- 消息发送/响应函数 ---
-def send_message(chat_id, text, reply_markup=None, retries=5, delay=2):
+# 所有 Bot API 调用共用一个连接池
+TELEGRAM_POOL_SIZE = int(os.environ.get("TELEGRAM_POOL_SIZE", 20))
+TELEGRAM_TIMEOUT = float(os.environ.get("TELEGRAM_TIMEOUT", 15))
+# 出站限流，默认值取自 Telegram 文档：全局约 30 条/秒，同一私聊约 1 条/秒，同一群组 20 条/分钟
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_CHAT_BURST = int(os.environ.get("TELEGRAM_CHAT_BURST", 3))
+TELEGRAM_GROUP_RATE_PER_MIN = float(os.environ.get("TELEGRAM_GROUP_RATE_PER_MIN", 20))
+TELEGRAM_MAX_RETRY_AFTER = float(os.environ.get("TELEGRAM_MAX_RETRY_AFTER", 60))
+OUTBOUND_LIMITER = OutboundLimiter(global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                                   chat_burst=TELEGRAM_CHAT_BURST, group_rate=TELEGRAM_GROUP_RATE_PER_MIN / 60,
+                                   max_wait=TELEGRAM_MAX_RETRY_AFTER)
+# 处理 update 的线程不等待会话限流：发往繁忙会话（主要是管理员会话，几乎每条未命中的留言都会转发过去）的请求
+# 转入发件箱按会话限流稍后投递，不会让所有 lane 排队等同一个会话的令牌；广播等后台发送传 wait=True 照常排队
+TELEGRAM = TelegramClient(BOT_URL, pool_size=TELEGRAM_POOL_SIZE, timeout=TELEGRAM_TIMEOUT, limiter=OUTBOUND_LIMITER,
+                          observer=observe_telegram, chat_wait=False)
+
+
+def send_message(chat_id, text, reply_markup=None, retries=5, delay=2, wait=None, priority=False):
     payload = {
         "chat_id": chat_id,
         "text": text,
@@ -118,43 +256,49 @@ def send_message(chat_id, text, reply_markup=None, retries=5, delay=2):
         payload["reply_markup"] = reply_markup
 
     logging.info(f"尝试发送消息到用户 {chat_id}: {text[:50]}...")
-    for attempt in range(retries):
-        try:
-            response = requests.post(
-                f"{BOT_URL}/sendMessage",
-                json=payload,
-                timeout=15
-            )
-            response.raise_for_status()
-            logging.info(f"消息成功发送到用户 {chat_id}")
-            return {"status": "success", "result": response.json()}
-        except requests.exceptions.RequestException as e:
-            error_msg = f"发送消息到 {chat_id} 失败 (尝试 {attempt + 1}/{retries}): {str(e)}"
-            logging.error(error_msg)
-            try:
-                if hasattr(e, 'response') and e.response:
-                    error_details = e.response.json()
-                    error_description = error_details.get('description', '未知 Telegram API 错误')
-                    logging.error(f"Telegram API 错误: {error_description}")
-                    if "bot was blocked" in error_description.lower():
-                        return {"status": "error", "error": "user_blocked", "description": error_description}
-                    elif "chat not found" in error_description.lower():
-                        return {"status": "error", "error": "chat_not_found", "description": error_description}
-                    elif "too many requests" in error_description.lower():
-                        time.sleep(delay * (2 ** attempt))
-                        continue
-                    return {"status": "error", "error": "api_error", "description": error_description}
-                else:
-                    error_description = f"无响应内容: {str(e)}"
-                    return {"status": "error", "error": "no_response", "description": error_description}
-            except Exception as parse_error:
-                error_description = f"无法解析 Telegram API 响应: {str(parse_error)}"
-                logging.error(error_description)
-                return {"status": "error", "error": "parse_error", "description": error_description}
-        time.sleep(delay * (2 ** attempt))
-    error_description = f"发送消息到 {chat_id} 失败：达到最大重试次数"
-    logging.error(error_description)
-    return {"status": "error", "error": "max_retries_exceeded", "description": error_description}
+    result = TELEGRAM.call("sendMessage", payload, retries=retries, delay=delay, wait=wait, priority=priority)
+    if result["status"] == "deferred":
+        logging.info(f"发往 {chat_id} 的消息已转入发件箱")
+    elif result["status"] == "success":
+        logging.info(f"消息成功发送到用户 {chat_id}")
+    return result
+
+
+# 不需要等结果的通知（拉黑/解封/申诉通知等）写入持久化发件箱后立即返回，由后台线程投递，重启后继续
+OUTBOX_FILE = os.environ.get("OUTBOX_FILE", "outbox.journal")
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", 2))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX = Outbox(OUTBOX_FILE, TELEGRAM, workers=OUTBOX_WORKERS, max_attempts=OUTBOX_MAX_ATTEMPTS, fsync=DB_FSYNC)
+TELEGRAM.defer = OUTBOX.put
+
+
+def enqueue_message(chat_id, text, reply_markup=None):
+    payload = {
+        "chat_id": chat_id,
+        "text": text,
+        "parse_mode": "HTML"
+    }
+
+    if reply_markup:
+        payload["reply_markup"] = reply_markup
+
+    OUTBOX.put("sendMessage", payload)
+
+
+def send_prompt(text, reply_markup=None):
+    """
+    发给管理员、之后要按 message_id 对应回复的提示消息（ForceReply 等）：不能转入发件箱，
+    只由管理员操作触发、量很小，所以不排在转发后面占用会话令牌，直接发送（429 暂停时仍会等待）。
+    返回 message_id，失败时返回 None。
+    """
+    return get_sent_message_id(send_message(ADMIN_ID, text, reply_markup=reply_markup, wait=True, priority=True))
+
+
+def get_sent_message_id(result):
+    """从 send_message 的返回结果中取出已发送消息的 message_id，失败时返回 None"""
+    if result.get("status") != "success":
+        return None
+    return result.get("result", {}).get("result", {}).get("message_id")
 
 
 def answer_callback_query(callback_query_id, text=None, show_alert=False):
@@ -163,95 +307,289 @@ def answer_callback_query(callback_query_id, text=None, show_alert=False):
         payload["text"] = text
     if show_alert:
         payload["show_alert"] = True
-    requests.post(f"{BOT_URL}/answerCallbackQuery", json=payload)
+    TELEGRAM.call("answerCallbackQuery", payload)
 
 
 # --- 统计功能 ---
 def update_stats(message_type="user_message", increment=1):
-    data = load_data()
-    stats = data["stats"]
-
     if message_type == "user_message":
-        stats["messages_received"] += increment
+        COUNTERS.incr("messages_received", increment)
     elif message_type == "admin_reply":
-        stats["replies_sent"] += increment
+        COUNTERS.incr("replies_sent", increment)
     elif message_type == "new_user":
-        stats["users_count"] = len(data["users"])
+        STORE.put("stats", "users_count", STORE.count("users"))
     elif message_type == "blacklist":
-        stats["blacklist_count"] = len(data["blacklist"])
+        STORE.put("stats", "blacklist_count", STORE.count("blacklist"))
     elif message_type == "egg_hit":
-        stats["egg_hits"] += increment
+        COUNTERS.incr("egg_hits", increment)
+
+
+# --- 广播 ---
+# 广播在后台线程中并发发送，总速率限制在 BROADCAST_RATE 条/秒（Telegram 的全局上限约 30 条/秒）
+# 进度按批写入 BROADCAST_FILE，进程重启后自动继续未完成的广播
+BROADCAST_FILE = os.environ.get("BROADCAST_FILE", "broadcast.json")
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 8))
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", 100))
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get("BROADCAST_PROGRESS_INTERVAL", 5))
+
+
+def broadcast_send(chat_id, text):
+    return send_message(chat_id, text, retries=3, wait=True)
+
+
+def format_broadcast_progress(job, finished):
+    if finished:
+        text = f"✅ 广播完成，消息已成功发送给 {job['sent']} 位用户，{job['failed']} 位用户发送失败。"
+        if job["unreachable"]:
+            text += f"\n其中 {job['unreachable']} 位用户已屏蔽机器人或账号不可用。"
+        return text
+    return (f"📣 正在广播... {job['done']}/{job['total']}\n"
+            f"成功：{job['sent']}，失败：{job['failed']}")
+
+
+def report_broadcast_progress(job, finished):
+    """创建任务时发送进度消息，之后原地编辑这条消息；编辑失败（或没有进度消息）时完成通知改为新发一条"""
+    text = format_broadcast_progress(job, finished)
+    message_id = job.get("progress_message_id")
+    if message_id:
+        result = TELEGRAM.call("editMessageText", {
+            "chat_id": ADMIN_ID,
+            "message_id": message_id,
+            "text": text
+        }, wait=True)
+        if result["status"] == "success" or not finished:
+            return message_id
+    return get_sent_message_id(send_message(ADMIN_ID, text, wait=True))
 
-    save_data(data)
+
+BROADCASTS = BroadcastManager(BROADCAST_FILE, broadcast_send, STORE.broadcast_targets, report_broadcast_progress,
+                              rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY,
+                              batch_size=BROADCAST_BATCH_SIZE, progress_interval=BROADCAST_PROGRESS_INTERVAL)
 
 
 # --- 彩蛋系统 ---
+@TRACER.traced()
+@STAGE_SECONDS.timed(stage="egg_keywords")
 def process_egg_keywords(text):
-    keywords_data = load_keywords()
-    eggs = keywords_data.get("eggs", [])
+    keyword_set = KEYWORDS.get()
 
-    for egg in eggs:
-        for keyword in egg["keywords"]:
-            if keyword.lower() in text.lower():
-                reply = egg["reply"]
+    # 单次扫描匹配全部关键词，多个命中时按文件顺序取第一个 egg
+    index = keyword_set.automaton.match(text.lower())
+    if index is None:
+        return None
 
-                # 处理动态内容
-                if "{prize}" in reply and "prizes" in keywords_data:
-                    prizes = keywords_data["prizes"]
-                    prize = random.choice(prizes)
-                    reply = reply.format(prize=prize)
+    reply = keyword_set.eggs[index]["reply"]
+    kind = keyword_set.reply_kinds[index]
 
-                elif "{time}" in reply:
-                    current_time = datetime.now().strftime("%H:%M:%S")
-                    reply = reply.replace("{time}", current_time)
+    # 处理动态内容
+    if kind == "prize":
+        prize = random.choice(keyword_set.prizes)
+        reply = reply.format(prize=prize)
 
-                elif "{date}" in reply:
-                    current_date = datetime.now().strftime("%Y年%m月%d日")
-                    reply = reply.replace("{date}", current_date)
+    elif kind == "time":
+        current_time = datetime.now().strftime("%H:%M:%S")
+        reply = reply.replace("{time}", current_time)
 
-                # 更新统计
-                update_stats("egg_hit")
+    elif kind == "date":
+        current_date = datetime.now().strftime("%Y年%m月%d日")
+        reply = reply.replace("{date}", current_date)
 
-                return reply
+    # 更新统计
+    update_stats("egg_hit")
 
-    return None
+    return reply
 
 
-# --- Webhook 路由 ---
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    data = request.get_json()
+# --- 转发给管理员 ---
+# FORWARD_COALESCE_WINDOW > 0 时，同一用户在该秒数内的留言合并进同一条转发，之后的留言以编辑的方式追加
+FORWARD_COALESCE_WINDOW = float(os.environ.get("FORWARD_COALESCE_WINDOW", 0))
+FORWARD_EDIT_INTERVAL = float(os.environ.get("FORWARD_EDIT_INTERVAL", 1))
+
+
+def forward_keyboard(user_id):
+    return json.dumps({
+        "inline_keyboard": [
+            [
+                {"text": "快捷回复", "callback_data": f"reply_{user_id}"},
+                {"text": "拉黑用户", "callback_data": f"block_{user_id}"}
+            ]
+        ]
+    })
+
+
+def send_forward(user_id, text):
+    """
+    合并窗口的第一条转发：之后要按 message_id 编辑，和 send_prompt 一样不能转入发件箱。
+    每个用户每个窗口只有这一条直接发送，其余留言合并成编辑，所以不占用管理员会话的令牌。
+    """
+    return get_sent_message_id(send_message(ADMIN_ID, text, reply_markup=forward_keyboard(user_id),
+                                            wait=True, priority=True))
+
 
+def edit_forward(user_id, message_id, text):
+    TELEGRAM.call("editMessageText", {
+        "chat_id": ADMIN_ID,
+        "message_id": message_id,
+        "text": text,
+        "parse_mode": "HTML",
+        "reply_markup": forward_keyboard(user_id)
+    }, wait=True)
+
+
+FORWARDS = ForwardCoalescer(send_forward, edit_forward, window=FORWARD_COALESCE_WINDOW,
+                            edit_interval=FORWARD_EDIT_INTERVAL)
+atexit.register(FORWARDS.flush)
+
+
+def forward_to_admin(user_id, username, text):
+    header = f"👤 用户 @{username} (ID:{user_id}) 发来消息：\n\n"
+    if FORWARD_COALESCE_WINDOW > 0:
+        FORWARDS.add(user_id, header, text)
+    else:
+        send_message(ADMIN_ID, header + text, reply_markup=forward_keyboard(user_id))
+
+
+# --- 防刷 ---
+# 每个用户突发 FLOOD_BURST 条，之后每秒恢复 FLOOD_RATE 条，超出的消息直接丢弃，不做匹配、不转发给管理员
+# FLOOD_AUTOBAN_THRESHOLD > 0 时，FLOOD_AUTOBAN_WINDOW 秒内被丢弃这么多条的用户会被自动拉黑
+FLOOD_RATE = float(os.environ.get("FLOOD_RATE", 1))
+FLOOD_BURST = int(os.environ.get("FLOOD_BURST", 5))
+FLOOD_AUTOBAN_THRESHOLD = int(os.environ.get("FLOOD_AUTOBAN_THRESHOLD", 0))
+FLOOD_AUTOBAN_WINDOW = float(os.environ.get("FLOOD_AUTOBAN_WINDOW", 60))
+FLOOD_GUARD = FloodGuard(rate=FLOOD_RATE, burst=FLOOD_BURST, abuse_threshold=FLOOD_AUTOBAN_THRESHOLD,
+                         abuse_window=FLOOD_AUTOBAN_WINDOW)
+
+
+def check_flood(user_id):
+    """消息可以继续处理时返回 True"""
+    verdict = FLOOD_GUARD.check(user_id)
+    if verdict == "ok":
+        return True
+    COUNTERS.incr("messages_throttled")
+    if verdict == "abuse":
+        reason = "消息发送过于频繁（自动拉黑）"
+        if STORE.add("blacklist", str(user_id), reason):
+            update_stats("blacklist")
+            logging.warning(f"用户 {user_id} 刷屏，已自动拉黑")
+            enqueue_message(ADMIN_ID, f"🚫 用户 {user_id} 短时间内发送大量消息，已自动加入黑名单。\n"
+                                      f"如需解除请使用 /unblock {user_id}")
+            enqueue_message(user_id, f"🚫 你已被加入黑名单，无法再继续使用本机器人。\n原因: {reason}")
+    return False
+
+
+# --- Update 处理 ---
+def process_update(data):
+    with TRACER.trace("update", update_id=data.get("update_id")):
+        dispatch_update(data)
+
+
+def dispatch_update(data):
     if "callback_query" in data:
-        handle_callback_query(data["callback_query"])
+        with UPDATE_SECONDS.time(type="callback_query"):
+            handle_callback_query(data["callback_query"])
     elif "message" in data:
         message = data["message"]
         user_id = message["from"]["id"]
 
+        if user_id != ADMIN_ID and not check_flood(user_id):
+            return
+
         # 更新统计信息
         update_stats()
 
         if user_id == ADMIN_ID:
-            handle_admin_message(message)
+            with UPDATE_SECONDS.time(type="admin_message"):
+                handle_admin_message(message)
         else:
-            handle_user_message(message)
+            with UPDATE_SECONDS.time(type="user_message"):
+                handle_user_message(message)
+
+
+def update_user_id(data):
+    """update 所属用户，同一用户的 update 按顺序处理（申诉、ForceReply、fallback_count 都依赖这一点）"""
+    if "callback_query" in data:
+        return data["callback_query"]["from"]["id"]
+    if "message" in data:
+        return data["message"]["from"]["id"]
+    return None
+
+
+# Webhook 只负责校验和入队，匹配、存储和发送消息都在工作线程里完成
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 4))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000))
+DISPATCHER = UpdateDispatcher(process_update, workers=WEBHOOK_WORKERS, maxsize=WEBHOOK_QUEUE_SIZE,
+                              key=update_user_id)
+atexit.register(DISPATCHER.drain)  # 最后注册最先执行：先处理完已接收的 update，再合并统计、落盘
+
+
+# 按 update_id 丢弃 Telegram 重发的 update，UPDATE_DEDUP_FILE 为空时不持久化
+UPDATE_DEDUP_WINDOW = int(os.environ.get("UPDATE_DEDUP_WINDOW", 10000))
+UPDATE_DEDUP_FILE = os.environ.get("UPDATE_DEDUP_FILE", "update_dedup.json")
+UPDATE_DEDUP = UpdateDeduplicator(UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_FILE or None)
+atexit.register(UPDATE_DEDUP.save)
+
+
+def is_duplicate_update(data):
+    update_id = data.get("update_id")
+    if isinstance(update_id, int) and UPDATE_DEDUP.seen(update_id):
+        logging.info(f"忽略重复的 update {update_id}")
+        return True
+    return False
+
+
+def is_valid_update(data):
+    if not isinstance(data, dict):
+        return False
+    if isinstance(data.get("callback_query"), dict):
+        return "from" in data["callback_query"] and "message" in data["callback_query"]
+    return isinstance(data.get("message"), dict) and "from" in data["message"]
+
+
+# --- Webhook 路由 ---
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    # gunicorn 等不经过 __main__ 的部署靠这里接手未完成的广播，多数请求里只是一次时间比较
+    BROADCASTS.resume()
+    with WEBHOOK_SECONDS.time():
+        result, status_code = handle_webhook()
+    WEBHOOK_REQUESTS.inc(result=result)
+    # 忽略和重复的 update 同样回复 ok，Telegram 只看状态码
+    return ("ok" if status_code == 200 else result), status_code
+
+
+def handle_webhook():
+    data = request.get_json(silent=True)
+
+    if not isinstance(data, dict):
+        return "bad request", 400
+    if not is_valid_update(data):
+        # 不处理的 update 类型（编辑消息、频道消息等）直接确认
+        return "ignored", 200
+    if is_duplicate_update(data):
+        return "duplicate", 200
+    if not DISPATCHER.submit(data):
+        # 队列已满，返回非 200 让 Telegram 稍后重发
+        logging.warning(f"update 队列已满，拒绝 update {data.get('update_id')}")
+        if isinstance(data.get("update_id"), int):
+            UPDATE_DEDUP.forget(data["update_id"])
+        return "busy", 503
 
     return "ok", 200
 
 
 # --- 用户消息处理 ---
+@TRACER.traced()
 def handle_user_message(message):
     user_id = message["from"]["id"]
     username = message["from"].get("username", "匿名用户")
     text = message.get("text", "")
     if text == "联系客服":
-        send_message(ADMIN_ID, f"👤 用户 {user_id} 请求人工客服")
+        enqueue_message(ADMIN_ID, f"👤 用户 {user_id} 请求人工客服")
         rmkb = json.dumps({"remove_keyboard": True})
-        send_message(user_id, "✅ 已收到您的人工客服请求，请稍候，客服人员将尽快联系您。", reply_markup=rmkb)
+        enqueue_message(user_id, "✅ 已收到您的人工客服请求，请稍候，客服人员将尽快联系您。", reply_markup=rmkb)
         return
 
-    data = load_data()
-
     # 检查用户是在做申诉回复
     reply_to = message.get("reply_to_message")
     if reply_to and reply_to.get("text", "").startswith("ℹ️ 请填写你的申诉理由"):
@@ -261,44 +599,38 @@ def handle_user_message(message):
             send_message(message["from"]["id"], "❌ 申诉理由不能为空！")
             return
         # 取出原 拉黑理由
-        data = load_data()
-        block_reason = data["blacklist"].get(user_id, "未知原因")
+        block_reason = STORE.get("blacklist", user_id, "未知原因")
         # 发给管理员
         kb = {"inline_keyboard": [[
             {"text": "解除拉黑", "callback_data": f"admin_unblock_{user_id}"},
             {"text": "拒绝申诉", "callback_data": f"deny_appeal_{user_id}"}
         ]]}
-        send_message(ADMIN_ID,
-                     f"📢 用户 {user_id} 申请申诉：\n"
-                     f"— 原拉黑原因：{block_reason}\n"
-                     f"— 申诉理由：{appeal_reason}",
-                     reply_markup=json.dumps(kb))
-        send_message(message["from"]["id"], "✅ 你的申诉已提交，请耐心等待。")
+        enqueue_message(ADMIN_ID,
+                        f"📢 用户 {user_id} 申请申诉：\n"
+                        f"— 原拉黑原因：{block_reason}\n"
+                        f"— 申诉理由：{appeal_reason}",
+                        reply_markup=json.dumps(kb))
+        enqueue_message(message["from"]["id"], "✅ 你的申诉已提交，请耐心等待。")
         # 清理 pending_actions
-        d = load_data()
-        d.get("pending_actions", {}).pop(f"appeal_{user_id}", None)
-        save_data(d)
+        PENDING.pop(f"appeal_{user_id}")
         return
 
     # 检查用户是否在黑名单中
-    if str(user_id) in data["blacklist"]:
-        reason = data["blacklist"][str(user_id)]
+    reason = STORE.get("blacklist", str(user_id))
+    if reason is not None:
         print(f"已屏蔽来自黑名单用户 {user_id} 的消息。原因: {reason}")
-        send_message(user_id, f"🚫 你已被管理员加入黑名单，无法继续使用本机器人。\n原因: {reason}")
+        enqueue_message(user_id, f"🚫 你已被管理员加入黑名单，无法继续使用本机器人。\n原因: {reason}")
         return
 
     # 记录用户信息
-    if str(user_id) not in data["users"]:
-        data["users"][str(user_id)] = {
-            "username": username,
-            "first_seen": int(time.time()),
-            "messages_count": 0
-        }
+    if STORE.add("users", str(user_id), {
+        "username": username,
+        "first_seen": int(time.time()),
+        "messages_count": 0
+    }):
         update_stats("new_user")
     else:
-        data["users"][str(user_id)]["messages_count"] += 1
-
-    save_data(data)
+        STORE.update("users", str(user_id), lambda u: dict(u, messages_count=u.get("messages_count", 0) + 1))
 
     # 处理命令和关键词
     if text == "/start":
@@ -347,38 +679,73 @@ def handle_user_message(message):
             return
 
         # 转发消息给管理员
-        forward_text = f"👤 用户 @{username} (ID:{user_id}) 发来消息：\n\n{text}"
-        keyboard = {
-            "inline_keyboard": [
-                [
-                    {"text": "快捷回复", "callback_data": f"reply_{user_id}"},
-                    {"text": "拉黑用户", "callback_data": f"block_{user_id}"}
-                ]
-            ]
-        }
-        send_message(ADMIN_ID, forward_text, reply_markup=json.dumps(keyboard))
+        forward_to_admin(user_id, username, text)
         human_triggers = ["人工", "客服", "转人工", "人工帮忙", "人工客服", "爆炸", "自杀"]
         if any(w in text for w in human_triggers):
             kb = {"inline_keyboard": [[{"text": "转人工客服", "callback_data": "to_human"}]]}
             send_message(user_id, "🤖 检测到您需要人工帮助，点击下方按钮转接人工客服。", reply_markup=json.dumps(kb))
         else:
             # 或者上下文触发：连续两次未命中时
-            session = data["users"].setdefault(str(user_id), {}).setdefault("fallback_count", 0)
-            data["users"][str(user_id)]["fallback_count"] = session + 1
-            save_data(data)
-            if data["users"][str(user_id)]["fallback_count"] >= 2:
+            user = STORE.update("users", str(user_id),
+                                lambda u: dict(u, fallback_count=u.get("fallback_count", 0) + 1), default={})
+            if user["fallback_count"] >= 2:
                 kb = {"inline_keyboard": [[{"text": "转人工客服", "callback_data": "to_human"}]]}
                 send_message(user_id, "🤖 看来机器人无法解决您的问题，是否需要人工客服？", reply_markup=json.dumps(kb))
-                data["users"][str(user_id)]["fallback_count"] = 0
-                save_data(data)
+                STORE.update("users", str(user_id), lambda u: dict(u, fallback_count=0), default={})
+
+# --- 词库编辑（/egg 菜单的 ForceReply 回复） ---
+KEYWORD_ACTIONS = ("egg_add", "egg_delete", "prize_add", "prize_delete")
+
+
+def handle_keyword_action(action, text, prompt_message_id):
+    # 缓存中的词库是共享的，修改前先复制一份
+    keywords_data = copy.deepcopy(KEYWORDS.get().data)
+    eggs = keywords_data.setdefault("eggs", [])
+    prizes = keywords_data.setdefault("prizes", [])
+    action_type = action["type"]
+
+    if action_type == "egg_add":
+        keyword_part, _, reply = text.partition("|")
+        keywords = [kw.strip() for kw in re.split(r"[,，]", keyword_part) if kw.strip()]
+        if not keywords or not reply.strip():
+            send_message(ADMIN_ID, "❌ 格式错误，应为：关键词1,关键词2|回复内容")
+            PENDING.put(prompt_message_id, action)
+            return
+        eggs.append({"keywords": keywords, "reply": reply.strip()})
+        result_text = f"✅ 已添加彩蛋，关键词：{', '.join(keywords)}"
+
+    elif action_type == "prize_add":
+        if not text:
+            send_message(ADMIN_ID, "❌ 奖品名称不能为空！")
+            PENDING.put(prompt_message_id, action)
+            return
+        prizes.append(text)
+        result_text = f"✅ 已添加奖品：{text}"
+
+    else:
+        items = eggs if action_type == "egg_delete" else prizes
+        if not text.isdigit() or not 1 <= int(text) <= len(items):
+            send_message(ADMIN_ID, f"❌ 请输入 1~{len(items)} 之间的序号！")
+            PENDING.put(prompt_message_id, action)
+            return
+        removed = items.pop(int(text) - 1)
+        if action_type == "egg_delete":
+            result_text = f"✅ 已删除彩蛋：{', '.join(removed['keywords'])}"
+        else:
+            result_text = f"✅ 已删除奖品：{removed}"
+
+    # 保存后缓存立即失效，新词库对下一条消息生效
+    save_keywords(keywords_data)
+    send_message(ADMIN_ID, result_text)
+
 
 # --- 管理员消息处理 ---
+@TRACER.traced()
 def handle_admin_message(message):
     text = message.get("text", "").strip()
     message_id = str(message["message_id"])
     user_id = message["from"]["id"]
 
-    data = load_data()
     reply_to_message = message.get("reply_to_message")
 
     # 情况 1：回复的是 Bot 发出的 "请直接回复此消息来回复用户 ..." 提示
@@ -392,10 +759,12 @@ def handle_admin_message(message):
         if not text:
             send_message(ADMIN_ID, "❌ 回复内容不能为空！")
             return
+        PENDING.pop(str(reply_to_message["message_id"]))
 
         # 发送管理员回复给目标用户
         reply_text = f"📨 管理员回复：\n\n{text}"
-        result = send_message(int(target_id), reply_text)
+        # 结果要告诉管理员，等到真正发出（或失败）为止，不转入发件箱
+        result = send_message(int(target_id), reply_text, wait=True)
 
         if result["status"] == "success":
             send_message(ADMIN_ID, f"✅ 回复已成功发送给用户 {target_id}。")
@@ -413,11 +782,11 @@ def handle_admin_message(message):
     # 情况 2：回复的是之前 bot 发出的 ForceReply 消息，判断是否在待处理操作中
     if reply_to_message:
         reply_to_msg_id = str(reply_to_message["message_id"])
-        pending_actions = data.get("pending_actions", {})
-        if reply_to_msg_id in pending_actions:
-            action = pending_actions.pop(reply_to_msg_id)
-            save_data(data)
-
+        action = PENDING.pop(reply_to_msg_id)
+        if action is not None and action["type"] in KEYWORD_ACTIONS:
+            handle_keyword_action(action, text, reply_to_msg_id)
+            return
+        if action is not None:
             target_id = action["target_id"]
 
             if action["type"] == "block":
@@ -425,13 +794,10 @@ def handle_admin_message(message):
                 if not reason:
                     send_message(ADMIN_ID, "❌ 拉黑原因不能为空！")
                     # 重新放回 pending_actions
-                    data["pending_actions"][reply_to_msg_id] = action
-                    save_data(data)
+                    PENDING.put(reply_to_msg_id, action)
                     return
 
-                if target_id not in data["blacklist"]:
-                    data["blacklist"][target_id] = reason
-                    save_data(data)
+                if STORE.add("blacklist", target_id, reason):
                     update_stats("blacklist")
                     send_message(ADMIN_ID, f"✅ 用户 {target_id} 已被拉黑。\n原因: {reason}")
                     try:
@@ -441,50 +807,18 @@ def handle_admin_message(message):
                                 [{"text": "我要申诉！", "callback_data": f"appeal_{target_id}"}]
                             ]
                         }
-                        send_message(int(target_id),
-                                     f"🚫 你已被管理员加入黑名单，无法再继续使用本机器人。\n原因: {reason}",
-                                     reply_markup=json.dumps(appeal_kb))
+                        enqueue_message(int(target_id),
+                                        f"🚫 你已被管理员加入黑名单，无法再继续使用本机器人。\n原因: {reason}",
+                                        reply_markup=json.dumps(appeal_kb))
                     except Exception as e:
                         logging.warning(f"通知用户 {target_id} 拉黑失败：{e}")
-
-                elif action["type"] == "reply":
-                    reply_text = text
-                    if not reply_text:
-                        send_message(ADMIN_ID, "❌ 回复内容不能为空！")
-                        return
-
-                    send_message(int(target_id), f"📨 管理员回复：\n\n{reply_text}")
-                    send_message(ADMIN_ID, f"✅ 已成功回复用户 {target_id}")
-                    update_stats("admin_reply")
-                    return
-
-                if action["type"] == "block_other":
-                    uid = action["target_id"]
-                    reason = text.strip()
-                    if not reason:
-                        send_message(ADMIN_ID, "❌ 原因不能为空！");
-                        return
-                    d = load_data()
-                    d["blacklist"][uid] = reason
-                    save_data(d);
-                    update_stats("blacklist")
-                    send_message(ADMIN_ID, f"✅ 用户 {uid} 已被拉黑，原因：{reason}")
-                    send_message(int(uid), f"🚫 你已被拉黑，原因：{reason}")
-                    # 更新原键盘
-                    requests.post(f"{BOT_URL}/editMessageText", json={
-                        "chat_id": reply_to["chat"]["id"],
-                        "message_id": reply_to["message_id"],
-                        "text": f"[已处理] 用户 {uid} 被拉黑 ({reason})",
-                        "reply_markup": json.dumps({"inline_keyboard": []})
-                    })
-
                 else:
-                    current_reason = data["blacklist"][target_id]
+                    current_reason = STORE.get("blacklist", target_id)
                     send_message(ADMIN_ID, f"ℹ️ 用户 {target_id} 已在黑名单中。\n原因: {current_reason}")
 
                 # 更新原始按钮消息为“已处理”
                 try:
-                    requests.post(f"{BOT_URL}/editMessageText", json={
+                    TELEGRAM.call("editMessageText", {
                         "chat_id": action["original_chat_id"],
                         "message_id": action["original_message_id"],
                         "text": f"[已处理] 用户 {target_id} 已被拉黑",
@@ -492,12 +826,43 @@ def handle_admin_message(message):
                     })
                 except Exception as e:
                     logging.warning(f"更新原始拉黑按钮消息失败：{e}")
+                return
 
-    # 情况 3：最后兜底，直接 message_id 命中 pending_actions 的情况（极少出现）
-    if message_id in data.get("pending_actions", {}):
-        action = data["pending_actions"].pop(message_id)
-        save_data(data)
+            elif action["type"] == "reply":
+                reply_text = text
+                if not reply_text:
+                    send_message(ADMIN_ID, "❌ 回复内容不能为空！")
+                    PENDING.put(reply_to_msg_id, action)
+                    return
+
+                send_message(int(target_id), f"📨 管理员回复：\n\n{reply_text}")
+                send_message(ADMIN_ID, f"✅ 已成功回复用户 {target_id}")
+                update_stats("admin_reply")
+                return
+
+            elif action["type"] == "block_other":
+                uid = action["target_id"]
+                reason = text.strip()
+                if not reason:
+                    send_message(ADMIN_ID, "❌ 原因不能为空！")
+                    PENDING.put(reply_to_msg_id, action)
+                    return
+                STORE.put("blacklist", uid, reason)
+                update_stats("blacklist")
+                send_message(ADMIN_ID, f"✅ 用户 {uid} 已被拉黑，原因：{reason}")
+                enqueue_message(int(uid), f"🚫 你已被拉黑，原因：{reason}")
+                # 更新原来的拉黑原因按钮消息
+                TELEGRAM.call("editMessageText", {
+                    "chat_id": action["original_chat_id"],
+                    "message_id": action["original_message_id"],
+                    "text": f"[已处理] 用户 {uid} 被拉黑 ({reason})",
+                    "reply_markup": json.dumps({"inline_keyboard": []})
+                })
+                return
 
+    # 情况 3：最后兜底，直接 message_id 命中 pending_actions 的情况（极少出现）
+    action = PENDING.pop(message_id)
+    if action is not None:
         if action["type"] == "block":
             target_id = action["target_id"]
             reason = text
@@ -506,9 +871,7 @@ def handle_admin_message(message):
                 send_message(ADMIN_ID, "❌ 拉黑原因不能为空！")
                 return
 
-            if target_id not in data["blacklist"]:
-                data["blacklist"][target_id] = reason
-                save_data(data)
+            if STORE.add("blacklist", target_id, reason):
                 update_stats("blacklist")
                 send_message(ADMIN_ID, f"✅ 用户 {target_id} 已被拉黑。\n原因: {reason}")
                 try:
@@ -518,18 +881,18 @@ def handle_admin_message(message):
                             [{"text": "我要申诉！", "callback_data": f"appeal_{target_id}"}]
                         ]
                     }
-                    send_message(int(target_id),
-                                 f"🚫 你已被管理员加入黑名单，无法再继续使用本机器人。\n原因: {reason}",
-                                 reply_markup=json.dumps(appeal_kb))
+                    enqueue_message(int(target_id),
+                                    f"🚫 你已被管理员加入黑名单，无法再继续使用本机器人。\n原因: {reason}",
+                                    reply_markup=json.dumps(appeal_kb))
                 except Exception as e:
                     logging.warning(f"向 {target_id} 发送拉黑通知失败：{e}")
             else:
-                current_reason = data["blacklist"][target_id]
+                current_reason = STORE.get("blacklist", target_id)
                 send_message(ADMIN_ID, f"ℹ️ 用户 {target_id} 已在黑名单中。\n当前原因: {current_reason}")
 
             # 更新原始消息内容
             try:
-                requests.post(f"{BOT_URL}/editMessageText", json={
+                TELEGRAM.call("editMessageText", {
                     "chat_id": action["original_chat_id"],
                     "message_id": action["original_message_id"],
                     "text": f"[已处理] 用户 {target_id} 已被拉黑",
@@ -549,24 +912,10 @@ def handle_admin_message(message):
                 send_message(ADMIN_ID, "❌ 格式错误，应为 /broadcast <要广播的内容>")
                 return
 
-            data = load_data()
-            all_users = data["users"].keys()
-            blacklist = data["blacklist"]
-
-            count = 0
-            failed = 0
-            for user_id_str in all_users:
-                if user_id_str not in blacklist:
-                    try:
-                        if send_message(int(user_id_str), args):
-                            count += 1
-                        else:
-                            failed += 1
-                        time.sleep(0.1)  # 避免触发API限制
-                    except Exception as e:
-                        print(f"广播到 {user_id_str} 失败: {e}")
-                        failed += 1
-            send_message(ADMIN_ID, f"✅ 广播完成，消息已成功发送给 {count} 位用户，{failed} 位用户发送失败。")
+            # 在后台发送，进度会实时更新在一条消息里
+            if BROADCASTS.start(args) is None:
+                job = BROADCASTS.current()
+                send_message(ADMIN_ID, f"❌ 已有广播正在进行（{job['done']}/{job['total']}），请等待完成后再试。")
 
         elif command == "/block":
             if not args or len(args.split()) < 2:
@@ -579,21 +928,18 @@ def handle_admin_message(message):
                 send_message(ADMIN_ID, "❌ 用户ID必须为数字！")
                 return
 
-            data = load_data()
-            if user_id_to_block not in data["blacklist"]:
-                data["blacklist"][user_id_to_block] = reason
-                save_data(data)
+            if STORE.add("blacklist", user_id_to_block, reason):
                 update_stats("blacklist")
                 send_message(ADMIN_ID, f"✅ 用户 {user_id_to_block} 已被加入黑名单。\n原因: {reason}")
 
                 # 通知被拉黑用户
                 try:
-                    send_message(int(user_id_to_block),
-                                 f"🚫 你已被管理员加入黑名单，无法再继续使用本机器人。\n原因: {reason}")
+                    enqueue_message(int(user_id_to_block),
+                                    f"🚫 你已被管理员加入黑名单，无法再继续使用本机器人。\n原因: {reason}")
                 except Exception as e:
                     print(f"向 {user_id_to_block} 发送拉黑通知失败：{e}")
             else:
-                current_reason = data["blacklist"][user_id_to_block]
+                current_reason = STORE.get("blacklist", user_id_to_block)
                 send_message(ADMIN_ID, f"ℹ️ 用户 {user_id_to_block} 已在黑名单中。\n当前原因: {current_reason}")
 
         elif command == "/unblock":
@@ -602,16 +948,13 @@ def handle_admin_message(message):
                 return
 
             user_id_to_unblock = args
-            data = load_data()
-            if user_id_to_unblock in data["blacklist"]:
-                del data["blacklist"][user_id_to_unblock]
-                save_data(data)
+            if STORE.pop("blacklist", user_id_to_unblock) is not None:
                 update_stats("blacklist")
                 send_message(ADMIN_ID, f"✅ 用户 {user_id_to_unblock} 已从黑名单移除。")
-                # 同步通知用户
+                # 通知用户
                 try:
-                    send_message(int(user_id_to_unblock),
-                                 "✅ 你已被管理员解除拉黑，现在可以继续使用机器人啦！")
+                    enqueue_message(int(user_id_to_unblock),
+                                    "✅ 你已被管理员解除拉黑，现在可以继续使用机器人啦！")
                 except Exception:
                     logging.warning(f"通知用户 {user_id_to_unblock} 解除拉黑失败")
 
@@ -619,23 +962,16 @@ def handle_admin_message(message):
                 send_message(ADMIN_ID, f"ℹ️ 用户 {user_id_to_unblock} 不在黑名单中。")
 
         elif command == "/blacklist":
-            data = load_data()
-            blacklist = data.get("blacklist", {})
-            if not blacklist:
+            page = render_blacklist_page()
+            if page is None:
                 send_message(ADMIN_ID, "📭 当前黑名单为空。")
             else:
-                lines = []
-                for uid, reason in blacklist.items():
-                    user_info = data["users"].get(uid, {})
-                    username = user_info.get("username", "（无用户名）")
-                    first_seen = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(user_info.get("first_seen", 0)))
-                    lines.append(f"- {uid} @{username}\n  拉黑原因: {reason}\n  首次加入: {first_seen}")
-                send_message(ADMIN_ID, "🚫 黑名单列表：\n" + "\n\n".join(lines))
+                text, keyboard = page
+                send_message(ADMIN_ID, text, reply_markup=keyboard)
 
         elif command == "/stats":
-            data = load_data()
-            stats = data["stats"]
-            active_users = len(data["users"]) - len(data["blacklist"])
+            stats = COUNTERS.snapshot()
+            active_users = STORE.count("users") - STORE.count("blacklist")
 
             message = "📊 机器人统计信息:\n\n"
             message += f"👥 总用户数: {stats['users_count']}\n"
@@ -644,6 +980,18 @@ def handle_admin_message(message):
             message += f"💬 收到消息总数: {stats['messages_received']}\n"
             message += f"↩️ 发送回复总数: {stats['replies_sent']}\n"
             message += f"🥚 彩蛋触发次数: {stats['egg_hits']}\n"
+            message += f"🛑 刷屏丢弃消息: {stats.get('messages_throttled', 0)}\n"
+
+            queue_stats = DISPATCHER.stats()
+            message += f"📥 待处理消息: {queue_stats['queue_depth']}\n"
+            if "latency_avg_ms" in queue_stats:
+                message += (f"⏱ 处理耗时: 平均 {queue_stats['latency_avg_ms']}ms，"
+                            f"P95 {queue_stats['latency_p95_ms']}ms\n")
+            message += f"🔁 忽略重复推送: {UPDATE_DEDUP.stats()['suppressed']}\n"
+            outbox_stats = OUTBOX.stats()
+            message += (f"📤 通知发件箱: 待发送 {outbox_stats['queued']}，发送中 {outbox_stats['in_flight']}，"
+                        f"已送达 {outbox_stats['delivered']}，重试 {outbox_stats['retried']}，"
+                        f"死信 {outbox_stats['dead']}\n")
 
             # 计算回复率
             if stats['messages_received'] > 0:
@@ -679,7 +1027,91 @@ def handle_admin_message(message):
             send_message(ADMIN_ID, help_text)
 
 
+# --- 分页列表 ---
+# 黑名单按用户ID做游标翻页，彩蛋/奖品按下标翻页，每次只渲染当前页；长字段截断，保证一页不超过 4096 字符
+# 列表页无论是新发还是翻页编辑都按 HTML 解析，用户输入的字段需要转义
+LIST_PAGE_SIZE = int(os.environ.get("LIST_PAGE_SIZE", 10))
+
+
+def shorten(text, limit=100):
+    text = str(text)
+    return html.escape(text[:limit]) + ("..." if len(text) > limit else "")
+
+
+def page_keyboard(prev_data, next_data, back_data=None):
+    nav = []
+    if prev_data:
+        nav.append({"text": "⬅️ 上一页", "callback_data": prev_data})
+    if next_data:
+        nav.append({"text": "下一页 ➡️", "callback_data": next_data})
+    rows = [nav] if nav else []
+    if back_data:
+        rows.append([{"text": "返回", "callback_data": back_data}])
+    return json.dumps({"inline_keyboard": rows})
+
+
+def render_blacklist_page(after=None, before=None):
+    """返回 (文本, 键盘)，黑名单为空时返回 None"""
+    entries, has_prev, has_next = STORE.blacklist_page(after=after, before=before, limit=LIST_PAGE_SIZE)
+    if not entries and (after is not None or before is not None):
+        # 翻页期间黑名单被清空了一部分，回到第一页
+        entries, has_prev, has_next = STORE.blacklist_page(limit=LIST_PAGE_SIZE)
+    if not entries:
+        return None
+
+    lines = []
+    for uid, reason, user_info in entries:
+        username = user_info.get("username", "（无用户名）")
+        first_seen = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(user_info.get("first_seen", 0)))
+        lines.append(f"- {uid} @{username}\n  拉黑原因: {shorten(reason)}\n  首次加入: {first_seen}")
+    text = f"🚫 黑名单列表（共 {STORE.count('blacklist')} 人）：\n" + "\n\n".join(lines)
+    keyboard = page_keyboard(f"blpage_p_{entries[0][0]}" if has_prev else None,
+                             f"blpage_n_{entries[-1][0]}" if has_next else None)
+    return text, keyboard
+
+
+def render_list_page(items, offset, title, callback_prefix, back_data, render_item):
+    """按下标翻页的通用列表，items 为空时返回 None"""
+    if not items:
+        return None
+    offset = max(0, min(offset, (len(items) - 1) // LIST_PAGE_SIZE * LIST_PAGE_SIZE))
+    page = items[offset:offset + LIST_PAGE_SIZE]
+    lines = [render_item(i, item) for i, item in enumerate(page, offset + 1)]
+    pages = (len(items) + LIST_PAGE_SIZE - 1) // LIST_PAGE_SIZE
+    text = f"{title}（第 {offset // LIST_PAGE_SIZE + 1}/{pages} 页）:\n\n" + "\n\n".join(lines)
+    keyboard = page_keyboard(f"{callback_prefix}{offset - LIST_PAGE_SIZE}" if offset > 0 else None,
+                             f"{callback_prefix}{offset + LIST_PAGE_SIZE}" if offset + LIST_PAGE_SIZE < len(items)
+                             else None,
+                             back_data)
+    return text, keyboard
+
+
+def render_egg_page(offset=0):
+    def render_egg(i, egg):
+        keywords = shorten(", ".join(egg["keywords"]))
+        return f"{i}. 关键词: {keywords}\n   回复: {shorten(egg['reply'], 50)}"
+
+    return render_list_page(KEYWORDS.get().eggs, offset, "🥚 彩蛋关键词列表", "egglist_", "back", render_egg)
+
+
+def render_prize_page(offset=0):
+    return render_list_page(KEYWORDS.get().prizes, offset, "🎁 奖品列表", "prizelist_", "egg_prize",
+                            lambda i, prize: f"{i}. {shorten(prize)}")
+
+
+def edit_list_message(chat_id, message_id, page):
+    text, keyboard = page
+    TELEGRAM.call("editMessageText", {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": text,
+        "parse_mode": "HTML",
+        "reply_markup": keyboard
+    })
+
+
 # --- 按钮操作处理 ---
+@TRACER.traced()
 def handle_callback_query(callback_query):
     query_id = callback_query["id"]
     from_user_id = callback_query["from"]["id"]
@@ -688,9 +1120,9 @@ def handle_callback_query(callback_query):
     data = callback_query["data"]
 
     if data == "to_human":
-        send_message(ADMIN_ID, f"👤 用户 {from_user_id} 点击“转人工客服”")
-        send_message(from_user_id, "✅ 您已请求人工客服，请稍后，客服人员将尽快联系您。")
-        requests.post(f"{BOT_URL}/editMessageReplyMarkup", json={
+        enqueue_message(ADMIN_ID, f"👤 用户 {from_user_id} 点击“转人工客服”")
+        enqueue_message(from_user_id, "✅ 您已请求人工客服，请稍后，客服人员将尽快联系您。")
+        TELEGRAM.call("editMessageReplyMarkup", {
             "chat_id": chat_id,
             "message_id": message_id,
             "reply_markup": json.dumps({"inline_keyboard": []})
@@ -701,20 +1133,17 @@ def handle_callback_query(callback_query):
     if data.startswith("appeal_"):
         user_to_appeal = data.split("_", 1)[1]
         # 仅允许被黑名单中的用户申诉
-        if user_to_appeal in load_data().get("blacklist", {}):
+        if STORE.get("blacklist", user_to_appeal) is not None:
             # 让用户填写申诉理由
             fr = json.dumps({"force_reply": True, "input_field_placeholder": "请输入申诉理由…"})
             send_message(int(user_to_appeal),
                          "ℹ️ 请填写你的申诉理由，我们会尽快处理。",
                          reply_markup=fr)
             # 存 pending appeal，待用户回复
-            d = load_data()
-            d.setdefault("pending_actions", {})
-            d["pending_actions"][f"appeal_{user_to_appeal}"] = {
+            PENDING.put(f"appeal_{user_to_appeal}", {
                 "type": "appeal",
                 "user_id": user_to_appeal
-            }
-            save_data(d)
+            })
             answer_callback_query(query_id)
         else:
             answer_callback_query(query_id, text="ℹ️ 你当前不在黑名单中，无需申诉。", show_alert=True)
@@ -735,7 +1164,7 @@ def handle_callback_query(callback_query):
                 [{"text": "返回", "callback_data": "back_main"}]
             ]
         }
-        requests.post(f"{BOT_URL}/editMessageText", json={
+        TELEGRAM.call("editMessageText", {
             "chat_id": chat_id,
             "message_id": message_id,
             "text": "🥚 彩蛋管理菜单:",
@@ -755,7 +1184,7 @@ def handle_callback_query(callback_query):
 /stats - 查看机器人统计信息
 /egg - 彩蛋关键词管理
 /help - 显示此帮助信息"""
-        requests.post(f"{BOT_URL}/editMessageText", json={
+        TELEGRAM.call("editMessageText", {
             "chat_id": chat_id,
             "message_id": message_id,
             "text": help_text,
@@ -764,82 +1193,88 @@ def handle_callback_query(callback_query):
         answer_callback_query(query_id)
         return
 
+    elif data.startswith("blpage_"):
+        # blpage_n_<最后一个用户ID> 下一页，blpage_p_<第一个用户ID> 上一页
+        _, direction, cursor = data.split("_", 2)
+        if direction == "n":
+            page = render_blacklist_page(after=cursor)
+        else:
+            page = render_blacklist_page(before=cursor)
+        if page is None:
+            TELEGRAM.call("editMessageText", {
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "text": "📭 当前黑名单为空。",
+                "reply_markup": json.dumps({"inline_keyboard": []})
+            })
+        else:
+            edit_list_message(chat_id, message_id, page)
+        answer_callback_query(query_id)
+        return
+
+    elif data.startswith("egglist_") or data.startswith("prizelist_"):
+        prefix, offset = data.split("_", 1)
+        page = render_egg_page(int(offset)) if prefix == "egglist" else render_prize_page(int(offset))
+        if page is not None:
+            edit_list_message(chat_id, message_id, page)
+        answer_callback_query(query_id)
+        return
+
     elif data.startswith("egg_"):
-        subcommand = data.split("_")[1]
-        keywords_data = load_keywords()
+        subcommand = data.split("_", 1)[1]
+        keywords_data = KEYWORDS.get().data
 
         if subcommand == "add":
             force_reply_markup = json.dumps({
                 "force_reply": True,
                 "input_field_placeholder": "格式: 关键词1,关键词2|回复内容"
             })
-            msg = send_message(ADMIN_ID, "请输入彩蛋信息 (格式: 关键词1,关键词2|回复内容):",
-                               reply_markup=force_reply_markup)
-            if not msg or "message_id" not in msg:
+            msg_id = send_prompt("请输入彩蛋信息 (格式: 关键词1,关键词2|回复内容):", reply_markup=force_reply_markup)
+            if not msg_id:
                 answer_callback_query(query_id, text="❌ 操作失败，请重试", show_alert=True)
                 return
+            PENDING.put(str(msg_id), {
+                "type": "egg_add",
+                "original_message_id": message_id,
+                "original_chat_id": chat_id
+            })
             answer_callback_query(query_id)
 
         elif subcommand == "list":
-            eggs = keywords_data.get("eggs", [])
-
-            if not eggs:
+            page = render_egg_page()
+            if page is None:
                 send_message(ADMIN_ID, "📭 当前没有设置任何彩蛋关键词。")
                 answer_callback_query(query_id)
                 return
 
-            lines = []
-            for i, egg in enumerate(eggs, 1):
-                keywords = ", ".join(egg["keywords"])
-                reply = egg["reply"][:50] + ("..." if len(egg["reply"]) > 50 else "")
-                lines.append(f"{i}. 关键词: {keywords}\n   回复: {reply}")
-
-            text = "🥚 彩蛋关键词列表:\n\n" + "\n\n".join(lines)
-            keyboard = {
-                "inline_keyboard": [
-                    [{"text": "返回", "callback_data": "back"}]
-                ]
-            }
-            requests.post(f"{BOT_URL}/editMessageText", json={
-                "chat_id": chat_id,
-                "message_id": message_id,
-                "text": text,
-                "reply_markup": json.dumps(keyboard)
-            })
+            edit_list_message(chat_id, message_id, page)
             answer_callback_query(query_id)
 
         elif subcommand == "delete":
-            eggs = keywords_data.get("eggs", [])
-
-            if not eggs:
+            # 列表可能很长，不能拼进一条提示消息：原菜单改为显示分页列表，提示里只让管理员回复序号
+            page = render_egg_page()
+            if page is None:
                 send_message(ADMIN_ID, "📭 当前没有设置任何彩蛋关键词。")
                 answer_callback_query(query_id)
                 return
 
-            lines = []
-            for i, egg in enumerate(eggs, 1):
-                keywords = ", ".join(egg["keywords"])
-                lines.append(f"{i}. {keywords}")
-
-            text = "请选择要删除的彩蛋:\n\n" + "\n".join(lines)
+            edit_list_message(chat_id, message_id, page)
+            text = f"请回复要删除的彩蛋序号（1~{len(keywords_data['eggs'])}，见上方列表，可翻页查看）:"
             force_reply_markup = json.dumps({
                 "force_reply": True,
                 "input_field_placeholder": "输入序号删除"
             })
-            msg = send_message(ADMIN_ID, text, reply_markup=force_reply_markup)
-            if not msg or "message_id" not in msg:
+            msg_id = send_prompt(text, reply_markup=force_reply_markup)
+            if not msg_id:
                 answer_callback_query(query_id, text="❌ 操作失败，请重试", show_alert=True)
                 return
 
             # 存储待处理的删除操作
-            data = load_data()
-            data.setdefault("pending_actions", {})
-            data["pending_actions"][str(msg["message_id"])] = {
+            PENDING.put(str(msg_id), {
                 "type": "egg_delete",
                 "original_message_id": message_id,
                 "original_chat_id": chat_id
-            }
-            save_data(data)
+            })
 
             answer_callback_query(query_id)
 
@@ -853,7 +1288,7 @@ def handle_callback_query(callback_query):
                     [{"text": "返回", "callback_data": "back"}]
                 ]
             }
-            requests.post(f"{BOT_URL}/editMessageText", json={
+            TELEGRAM.call("editMessageText", {
                 "chat_id": chat_id,
                 "message_id": message_id,
                 "text": "🎁 奖品管理菜单:",
@@ -866,63 +1301,51 @@ def handle_callback_query(callback_query):
                 "force_reply": True,
                 "input_field_placeholder": "输入奖品名称"
             })
-            msg = send_message(ADMIN_ID, "请输入要添加的奖品名称:", reply_markup=force_reply_markup)
-            if not msg or "message_id" not in msg:
+            msg_id = send_prompt("请输入要添加的奖品名称:", reply_markup=force_reply_markup)
+            if not msg_id:
                 answer_callback_query(query_id, text="❌ 操作失败，请重试", show_alert=True)
                 return
+            PENDING.put(str(msg_id), {
+                "type": "prize_add",
+                "original_message_id": message_id,
+                "original_chat_id": chat_id
+            })
             answer_callback_query(query_id)
 
         elif subcommand == "prize_list":
-            prizes = keywords_data.get("prizes", [])
-
-            if not prizes:
+            page = render_prize_page()
+            if page is None:
                 send_message(ADMIN_ID, "📭 当前没有设置任何奖品。")
                 answer_callback_query(query_id)
                 return
 
-            lines = [f"{i}. {prize}" for i, prize in enumerate(prizes, 1)]
-            text = "🎁 奖品列表:\n\n" + "\n".join(lines)
-            keyboard = {
-                "inline_keyboard": [
-                    [{"text": "返回", "callback_data": "egg_prize"}]
-                ]
-            }
-            requests.post(f"{BOT_URL}/editMessageText", json={
-                "chat_id": chat_id,
-                "message_id": message_id,
-                "text": text,
-                "reply_markup": json.dumps(keyboard)
-            })
+            edit_list_message(chat_id, message_id, page)
             answer_callback_query(query_id)
 
         elif subcommand == "prize_delete":
-            prizes = keywords_data.get("prizes", [])
-
-            if not prizes:
+            page = render_prize_page()
+            if page is None:
                 send_message(ADMIN_ID, "📭 当前没有设置任何奖品。")
                 answer_callback_query(query_id)
                 return
 
-            lines = [f"{i}. {prize}" for i, prize in enumerate(prizes, 1)]
-            text = "请选择要删除的奖品:\n\n" + "\n".join(lines)
+            edit_list_message(chat_id, message_id, page)
+            text = f"请回复要删除的奖品序号（1~{len(keywords_data['prizes'])}，见上方列表，可翻页查看）:"
             force_reply_markup = json.dumps({
                 "force_reply": True,
                 "input_field_placeholder": "输入序号删除"
             })
-            msg = send_message(ADMIN_ID, text, reply_markup=force_reply_markup)
-            if not msg or "message_id" not in msg:
+            msg_id = send_prompt(text, reply_markup=force_reply_markup)
+            if not msg_id:
                 answer_callback_query(query_id, text="❌ 操作失败，请重试", show_alert=True)
                 return
 
             # 存储待处理的删除操作
-            data = load_data()
-            data.setdefault("pending_actions", {})
-            data["pending_actions"][str(msg["message_id"])] = {
+            PENDING.put(str(msg_id), {
                 "type": "prize_delete",
                 "original_message_id": message_id,
                 "original_chat_id": chat_id
-            }
-            save_data(data)
+            })
 
             answer_callback_query(query_id)
 
@@ -931,20 +1354,17 @@ def handle_callback_query(callback_query):
         force_reply_markup = json.dumps({"force_reply": True})
         prompt_message = f"💬 请直接回复此消息来回复用户 {target_id_str}：\n\n用户ID: {target_id_str}"
 
-        result = send_message(ADMIN_ID, prompt_message, reply_markup=force_reply_markup)
+        result = send_message(ADMIN_ID, prompt_message, reply_markup=force_reply_markup, wait=True, priority=True)
         if result["status"] == "success":
             result_data = result.get("result", {}).get("result", {})
             message_id_sent = result_data.get("message_id")
             if message_id_sent:
-                data = load_data()
-                data.setdefault("pending_actions", {})
-                data["pending_actions"][str(message_id_sent)] = {
+                PENDING.put(str(message_id_sent), {
                     "type": "reply",
                     "target_id": target_id_str,
                     "original_message_id": message_id,
                     "original_chat_id": chat_id
-                }
-                save_data(data)
+                })
                 logging.info(f"✅ 存储待处理回复操作：message_id={message_id_sent}, target_id={target_id_str}")
                 answer_callback_query(query_id)
                 return
@@ -979,21 +1399,20 @@ def handle_callback_query(callback_query):
                 "force_reply": True,
                 "input_field_placeholder": "请输入其他拉黑原因"
             })
-            send_message(ADMIN_ID, "✍️ 请输入具体拉黑原因：", reply_markup=fr)
-            # 存 pending_actions 标记
-            d = load_data()
-            d.setdefault("pending_actions", {})[str(message_id)] = {
+            prompt_id = send_prompt("✍️ 请输入具体拉黑原因：", reply_markup=fr)
+            if not prompt_id:
+                answer_callback_query(query_id, text="❌ 操作失败，请重试", show_alert=True)
+                return
+            # 以提示消息的 id 为 key，管理员回复这条提示时才能找到
+            PENDING.put(str(prompt_id), {
                 "type": "block_other",
                 "target_id": uid,
                 "original_chat_id": chat_id,
                 "original_message_id": message_id
-            }
-            save_data(d)
+            })
         else:
             # 直接拉黑
-            d = load_data()
-            d["blacklist"][uid] = reason
-            save_data(d);
+            STORE.put("blacklist", uid, reason)
             update_stats("blacklist")
             send_message(ADMIN_ID, f"✅ 用户 {uid} 已被拉黑，原因：{reason}")
             # 给用户发送申诉按钮
@@ -1002,9 +1421,9 @@ def handle_callback_query(callback_query):
                     [{"text": "我要申诉！", "callback_data": f"appeal_{uid}"}]
                 ]
             }
-            send_message(int(uid),f"🚫 你已被管理员拉黑，原因：{reason}",reply_markup=json.dumps(appeal_kb))
+            enqueue_message(int(uid),f"🚫 你已被管理员拉黑，原因：{reason}",reply_markup=json.dumps(appeal_kb))
             # 更新原按钮
-            requests.post(f"{BOT_URL}/editMessageText", json={
+            TELEGRAM.call("editMessageText", {
                 "chat_id": chat_id, "message_id": message_id,
                 "text": f"[已处理] 用户 {uid} 被拉黑 ({reason})",
                 "reply_markup": json.dumps({"inline_keyboard": []})
@@ -1017,17 +1436,14 @@ def handle_callback_query(callback_query):
     elif data.startswith("admin_unblock_"):
         uid = data.split("_", 2)[2]
         # 1) 解除黑名单
-        d = load_data()
-        if uid in d["blacklist"]:
-            del d["blacklist"][uid]
-            save_data(d);
+        if STORE.pop("blacklist", uid) is not None:
             update_stats("blacklist")
             send_message(ADMIN_ID, f"✅ 已解除用户 {uid} 的黑名单。")
-            send_message(int(uid), "✅ 管理员已同意你的申诉，已解除拉黑。")
+            enqueue_message(int(uid), "✅ 管理员已同意你的申诉，已解除拉黑。")
         else:
             send_message(ADMIN_ID, f"ℹ️ 用户 {uid} 不在黑名单中。")
         # 2) 更新原按钮消息为“已处理”
-        requests.post(f"{BOT_URL}/editMessageText", json={
+        TELEGRAM.call("editMessageText", {
             "chat_id": chat_id,
             "message_id": message_id,
             "text": "[已处理] 已同意解除拉黑",
@@ -1039,9 +1455,9 @@ def handle_callback_query(callback_query):
     elif data.startswith("deny_appeal_"):
         uid = data.split("_", 2)[2]
         send_message(ADMIN_ID, f"❌ 已拒绝用户 {uid} 的申诉。")
-        send_message(int(uid), "❌ 管理员已拒绝你的申诉，仍维持黑名单状态。")
+        enqueue_message(int(uid), "❌ 管理员已拒绝你的申诉，仍维持黑名单状态。")
         # 更新原按钮消息为“已处理”
-        requests.post(f"{BOT_URL}/editMessageText", json={
+        TELEGRAM.call("editMessageText", {
             "chat_id": chat_id,
             "message_id": message_id,
             "text": "[已处理] 已拒绝申诉",
@@ -1059,7 +1475,7 @@ def set_user_commands():
         {"command": "about", "description": "了解更多关于我们的信息"},
         {"command": "to_human", "description": "请求人工服务"}
     ]
-    requests.post(f"{BOT_URL}/setMyCommands", json={
+    TELEGRAM.call("setMyCommands", {
         "commands": commands,
         "scope": {"type": "default"}
     })
@@ -1075,7 +1491,7 @@ def set_admin_commands():
         {"command": "egg", "description": "管理彩蛋关键词"},
         {"command": "help", "description": "查看帮助信息"}
     ]
-    requests.post(f"{BOT_URL}/setMyCommands", json={
+    TELEGRAM.call("setMyCommands", {
         "commands": commands,
         "scope": {"type": "chat", "chat_id": ADMIN_ID}
     })
@@ -1084,20 +1500,79 @@ def set_admin_commands():
 # --- 健康检查 ---
 @app.route("/", methods=["GET"])
 def index():
+    if not READY.is_set():
+        return "Warming up", 503
     return "Bot is running!", 200
 
 
+@app.route("/status", methods=["GET"])
+def status():
+    return jsonify({"updates": DISPATCHER.stats(), "broadcast": BROADCASTS.current(),
+                    "outbound": OUTBOUND_LIMITER.stats(), "dedup": UPDATE_DEDUP.stats(),
+                    "forwards": FORWARDS.stats(), "outbox": OUTBOX.stats(), "tracing": TRACER.stats(),
+                    "ready": READY.is_set()})
+
+
+# 以下指标在抓取时读取，不占用处理 update 的时间
+Gauge("bot_ready", "分词器和词库是否已预热完成", lambda: int(READY.is_set()))
+Gauge("bot_users", "用户数", lambda: STORE.count("users"))
+Gauge("bot_blacklisted_users", "黑名单用户数", lambda: STORE.count("blacklist"))
+Gauge("bot_update_queue_depth", "等待处理的 update 数", lambda: DISPATCHER.stats()["queue_depth"])
+Gauge("bot_outbox_messages", "发件箱中未送达的通知数", lambda: {(state, ): OUTBOX.stats()[state]
+                                                           for state in ("queued", "in_flight")}, ["state"])
+Gauge("bot_outbox_dead_letters_total", "发件箱死信数", lambda: OUTBOX.stats()["dead"], type="counter")
+Gauge("bot_pending_actions", "等待管理员回复的操作数", lambda: PENDING.stats()["pending"])
+Gauge("bot_open_forwards", "仍在合并窗口内的转发数", lambda: FORWARDS.stats()["open"])
+Gauge("bot_outbound_paused_chats", "因 429 暂停发送的会话数", lambda: OUTBOUND_LIMITER.stats()["paused_chats"])
+Gauge("bot_events_total", "累计事件数（与 /stats 一致）",
+      lambda: {(name, ): value for name, value in COUNTERS.snapshot().items()
+               if name in ("messages_received", "replies_sent", "egg_hits", "messages_throttled")},
+      ["event"], type="counter")
+Gauge("bot_updates_suppressed_total", "丢弃的重复 update 数", lambda: UPDATE_DEDUP.stats()["suppressed"],
+      type="counter")
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 # --- 启动 ---
+# BOT_MODE=webhook（默认）：启动 Flask 接收 webhook；BOT_MODE=polling：不需要公网地址，用 getUpdates 长轮询
+BOT_MODE = os.environ.get("BOT_MODE", "webhook")
+POLLING_OFFSET_FILE = os.environ.get("POLLING_OFFSET_FILE", "polling_offset")
+POLLING_LIMIT = int(os.environ.get("POLLING_LIMIT", 100))
+POLLING_TIMEOUT = int(os.environ.get("POLLING_TIMEOUT", 30))
+
 if __name__ == '__main__':
+    # 只生成 jieba 词典缓存（配合 JIEBA_CACHE_DIR），用于构建镜像时预先准备
+    if len(sys.argv) > 1 and sys.argv[1] == "warmup":
+        READY.wait()
+        sys.exit(0)
+
+    # SIGTERM 时正常退出，确保 atexit 中的落盘逻辑得到执行
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     # 启动后立即设置菜单
     set_user_commands()
     set_admin_commands()
 
     # 确保数据文件存在
-    if not os.path.exists(DB_FILE):
+    if DB_BACKEND == "json" and not os.path.exists(DB_FILE):
         save_data(load_data())
+        STORE.flush()
     if not os.path.exists(KEYWORD_FILE):
         save_keywords(load_keywords())
 
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host='0.0.0.0', port=port)
+    DISPATCHER.start()
+    BROADCASTS.resume()
+    logging.info(f"启动完成，耗时 {time.perf_counter() - STARTUP_BEGIN:.2f} 秒"
+                 f"{'' if READY.is_set() else '，分词器仍在后台预热'}")
+    if BOT_MODE == "polling":
+        poller = UpdatePoller(TELEGRAM, DISPATCHER, POLLING_OFFSET_FILE, limit=POLLING_LIMIT,
+                              timeout=POLLING_TIMEOUT,
+                              accept=lambda update: is_valid_update(update) and not is_duplicate_update(update))
+        poller.run()
+    else:
+        port = int(os.environ.get("PORT", 5000))
+        app.run(host='0.0.0.0', port=port)
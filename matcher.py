@@ -0,0 +1,184 @@
+import os
+import threading
+from collections import Counter, deque
+
+from rapidfuzz import fuzz, process
+
+NO_MATCH = float("inf")
+
+
+class KeywordAutomaton:
+    """
+    多模式 Aho-Corasick 自动机：一次扫描文本即可找出命中的关键词。
+    每个关键词带一个优先级（所在 egg 的下标），match() 返回命中关键词中最小的优先级，
+    与逐个 egg 按文件顺序检查、第一个命中的生效完全一致。
+    """
+
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        self._best = [NO_MATCH]
+        # 空关键词在原实现里会命中任意文本
+        self._empty = NO_MATCH
+
+        for pattern, priority in patterns:
+            if not pattern:
+                self._empty = min(self._empty, priority)
+                continue
+            node = 0
+            for ch in pattern:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._best.append(NO_MATCH)
+                node = nxt
+            self._best[node] = min(self._best[node], priority)
+
+        # 广度优先构建失败指针，并把后缀节点的优先级合并进来
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._best[child] = min(self._best[child], self._best[self._fail[child]])
+                queue.append(child)
+
+    def match(self, text):
+        """返回命中的最小优先级，未命中返回 None；text 需要已按建树时的方式规范化（小写）"""
+        goto, fail, best_at = self._goto, self._fail, self._best
+        best = self._empty
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if best_at[node] < best:
+                best = best_at[node]
+                if best == 0:
+                    break
+        return None if best == NO_MATCH else best
+
+
+def build_egg_automaton(eggs):
+    return KeywordAutomaton((keyword.lower(), index)
+                            for index, egg in enumerate(eggs)
+                            for keyword in egg["keywords"])
+
+
+class FuzzyIndex:
+    """
+    semantic_match 用的模糊匹配索引：关键词小写、去重后集中存放，并映射回所属 egg 的下标。
+
+    partial_ratio >= T 要求关键词与文本至少有 T/(200-T) * min(两者长度) 个公共字符，
+    先用字符倒排表算出公共字符数，把不可能达标的关键词剪掉，剩下的交给
+    rapidfuzz 的 process.extractOne 按 score_cutoff 批量打分。
+    """
+
+    def __init__(self, eggs):
+        self.choices = []
+        self.egg_indices = []
+        # 字符 -> [(关键词下标, 该字符在关键词中出现的次数)]
+        self._postings = {}
+        seen = set()
+        for egg_index, egg in enumerate(eggs):
+            for keyword in egg["keywords"]:
+                keyword = keyword.lower()
+                if keyword in seen:
+                    continue
+                seen.add(keyword)
+                choice_index = len(self.choices)
+                self.choices.append(keyword)
+                self.egg_indices.append(egg_index)
+                for ch, n in Counter(keyword).items():
+                    self._postings.setdefault(ch, []).append((choice_index, n))
+
+    def _candidates(self, query, threshold):
+        common = {}
+        for ch, query_n in Counter(query).items():
+            for choice_index, n in self._postings.get(ch, ()):
+                common[choice_index] = common.get(choice_index, 0) + (n if n < query_n else query_n)
+        query_len = len(query)
+        choices = self.choices
+        # 用整数比较代替 common >= T/(200-T) * min_len，避免浮点误差误删边界上的关键词
+        return sorted(i for i, n in common.items()
+                      if n * (200 - threshold) >= threshold * min(len(choices[i]), query_len))
+
+    def best(self, query, threshold):
+        """返回得分最高且不低于 threshold 的关键词所属 egg 下标，同分时取文件中靠前的；没有则返回 None"""
+        if threshold > 0:
+            candidates = self._candidates(query, threshold)
+        else:
+            candidates = range(len(self.choices))
+        if not candidates:
+            return None
+        result = process.extractOne(query, [self.choices[i] for i in candidates],
+                                    scorer=fuzz.partial_ratio, processor=None, score_cutoff=threshold)
+        if result is None:
+            return None
+        return self.egg_indices[candidates[result[2]]]
+
+
+class KeywordSet:
+    """
+    一次加载得到的词库及其派生结构：关键词自动机、模糊匹配索引，以及每个 egg 回复中需要填充的动态内容类型。
+    创建之后不再修改，可在多个线程间共享。
+    """
+
+    def __init__(self, data, stamp=None):
+        self.data = data
+        self.stamp = stamp
+        self.eggs = data.get("eggs", [])
+        self.prizes = data.get("prizes", [])
+        self.automaton = build_egg_automaton(self.eggs)
+        self.fuzzy = FuzzyIndex(self.eggs)
+        # 与原来的判断顺序一致：{prize}（且词库里有 prizes）优先，其次 {time}、{date}
+        self.reply_kinds = []
+        for egg in self.eggs:
+            reply = egg["reply"]
+            if "{prize}" in reply and "prizes" in data:
+                self.reply_kinds.append("prize")
+            elif "{time}" in reply:
+                self.reply_kinds.append("time")
+            elif "{date}" in reply:
+                self.reply_kinds.append("date")
+            else:
+                self.reply_kinds.append(None)
+
+
+class KeywordCache:
+    """
+    keywords.json 的缓存：每次 get() 只 stat 一次文件，mtime 或大小变化、
+    或者调用过 invalidate() 之后才重新解析并重建 KeywordSet。
+    """
+
+    def __init__(self, path, loader):
+        self.path = path
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._current = None
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def get(self):
+        stamp = self._stamp()
+        current = self._current
+        if current is not None and current.stamp == stamp:
+            return current
+        with self._lock:
+            if self._current is None or self._current.stamp != stamp:
+                self._current = KeywordSet(self._loader(), stamp)
+            return self._current
+
+    def invalidate(self):
+        self._current = None
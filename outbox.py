@@ -0,0 +1,284 @@
+import glob
+import heapq
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+from telegram_api import RETRYABLE_ERRORS
+
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 fcntl，只能单进程使用
+    fcntl = None
+
+
+class Outbox:
+    """
+    持久化发件箱：不需要等待结果的通知先追加写入日志文件再返回，由后台线程投递。
+
+    投递失败时按 base_delay * 2^n 退避（429 按 retry_after）重试，成功后在日志里记一条 ack；
+    不可重试的错误或超过 max_attempts 次的消息记为死信，另存到 path + ".dead" 方便排查。
+    进程重启时重放日志，未 ack 的消息继续投递（至少一次：退出时正在发送的那条可能重复）。
+
+    多进程部署（如 gunicorn 多 worker）共用同一个 path：每个进程写自己的 path + ".<pid>"，
+    并在进程存活期间对其 ".lock" 文件持有 flock；启动时接管没有进程持锁的日志（上次退出的进程留下的），
+    重放其中的消息后删除。死信文件各进程共用。
+    """
+
+    def __init__(self, path, client, workers=2, max_attempts=8, base_delay=2, max_delay=300,
+                 compact_threshold=1000, fsync=False):
+        self.base_path = path
+        self.path = f"{path}.{os.getpid()}" if fcntl is not None else path
+        self.dead_path = path + ".dead"
+        self.client = client
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.compact_threshold = compact_threshold
+        self.fsync = fsync
+
+        self._cond = threading.Condition()
+        self._file_lock = threading.Lock()
+        self._messages = {}
+        # (下次投递时间, 序号, id)
+        self._ready = []
+        self._seq = itertools.count()
+        self._threads = []
+        self.in_flight = 0
+        self.delivered = 0
+        self.retried = 0
+        self.dead = self._count_dead()
+
+        self._lock_file = None
+        orphans = self._claim_orphans()
+        for orphan_path, _ in orphans:
+            self._load(orphan_path)
+        now = time.monotonic()
+        for message_id in self._messages:
+            heapq.heappush(self._ready, (now, next(self._seq), message_id))
+        if self._messages:
+            logging.info(f"发件箱中有 {len(self._messages)} 条未投递的消息，继续投递")
+        self._file = None
+        # 先把接管的消息写进自己的日志再删除原文件，中途退出最多重复投递，不会丢
+        self._rewrite()
+        for orphan_path, lock_file in orphans:
+            if orphan_path != self.path:
+                self._remove(orphan_path)
+                if lock_file is not None:
+                    self._remove(orphan_path + ".lock")
+                    lock_file.close()
+        if self._messages:
+            self.start()
+
+    # --- 日志 ---
+    def _count_dead(self):
+        try:
+            with open(self.dead_path, "r", encoding="utf-8") as f:
+                return sum(1 for _ in f)
+        except FileNotFoundError:
+            return 0
+
+    def _lock(self, path, blocking=True):
+        """对 path + ".lock" 加排他锁，成功返回打开的锁文件，已被其他进程持有时返回 None"""
+        lock_file = open(path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _claim_orphans(self):
+        """锁住自己的日志，并接管没有进程持锁的日志，返回 [(日志路径, 锁文件)]"""
+        if fcntl is None:
+            return [(self.path, None)]
+        # pid 可能被复用，自己的路径上也可能留有旧日志，同样要重放
+        self._lock_file = self._lock(self.path, blocking=False)
+        if self._lock_file is None:
+            raise RuntimeError(f"发件箱日志 {self.path} 已被同一进程中的另一个 Outbox 使用")
+        claimed = [(self.path, None)]
+        pattern = re.compile(re.escape(self.base_path) + r"(\.\d+)?$")
+        for path in sorted(glob.glob(glob.escape(self.base_path) + "*")):
+            if path == self.path or not pattern.match(path):
+                continue
+            lock_file = self._lock(path, blocking=False)
+            if lock_file is None:
+                # 所属进程还活着
+                continue
+            if not os.path.exists(path):
+                # 锁文件是另一个进程刚接管完留下的
+                self._remove(path + ".lock")
+                lock_file.close()
+                continue
+            claimed.append((path, lock_file))
+        return claimed
+
+    def _load(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 写了一半的最后一行，之后的内容不可信
+                        logging.warning(f"发件箱日志 {path} 末尾不完整，已忽略")
+                        break
+                    op, message_id = record["op"], record["id"]
+                    if op == "add":
+                        self._messages[message_id] = {"id": message_id, "method": record["method"],
+                                                      "payload": record["payload"],
+                                                      "attempts": record.get("attempts", 0),
+                                                      "created_at": record.get("created_at")}
+                    elif op == "retry" and message_id in self._messages:
+                        self._messages[message_id]["attempts"] = record["attempts"]
+                    elif op in ("ack", "dead"):
+                        self._messages.pop(message_id, None)
+        except FileNotFoundError:
+            return
+        if path != self.path:
+            logging.info(f"接管了已退出进程的发件箱日志 {path}")
+
+    def _rewrite(self):
+        """把日志压缩成只包含未投递消息的 add 记录"""
+        with self._file_lock:
+            with self._cond:
+                records = [dict(message, op="add") for message in self._messages.values()]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._lines = len(records)
+
+    def _append(self, record):
+        with self._file_lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._lines += 1
+            compact = self._lines >= self.compact_threshold
+        if compact:
+            self._rewrite()
+
+    # --- 对外接口 ---
+    def put(self, method, payload):
+        """写入日志后立即返回消息 id，实际发送在后台完成"""
+        message = {"id": uuid.uuid4().hex, "method": method, "payload": payload,
+                   "attempts": 0, "created_at": int(time.time())}
+        # 先登记再写日志，这样压缩日志时不会漏掉这条
+        with self._cond:
+            self._messages[message["id"]] = message
+        self._append(dict(message, op="add"))
+        with self._cond:
+            heapq.heappush(self._ready, (time.monotonic(), next(self._seq), message["id"]))
+            self._cond.notify()
+        self.start()
+        return message["id"]
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    # --- 投递 ---
+    def _next(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._ready and self._ready[0][0] <= now:
+                    _, _, message_id = heapq.heappop(self._ready)
+                    message = self._messages.get(message_id)
+                    if message is None:
+                        continue
+                    self.in_flight += 1
+                    return message
+                self._cond.wait(self._ready[0][0] - now if self._ready else None)
+
+    def _worker(self):
+        while True:
+            message = self._next()
+            try:
+                # 不在这里等会话限流，繁忙会话的消息重新排期，不占住工作线程
+                result = self.client.call(message["method"], message["payload"], retries=1, wait=False, defer=False)
+            except Exception as e:
+                logging.exception(f"投递发件箱消息 {message['id']} 出错")
+                result = {"status": "error", "error": "exception", "description": str(e)}
+            try:
+                self._finish(message, result)
+            finally:
+                with self._cond:
+                    self.in_flight -= 1
+
+    def _finish(self, message, result):
+        if result["status"] == "success":
+            with self._cond:
+                self._messages.pop(message["id"], None)
+                self.delivered += 1
+            self._append({"op": "ack", "id": message["id"]})
+            return
+
+        if result.get("throttled"):
+            # 本地限流，请求没有发出，不计入尝试次数
+            with self._cond:
+                heapq.heappush(self._ready, (time.monotonic() + result["retry_after"], next(self._seq), message["id"]))
+                self._cond.notify()
+            return
+
+        attempts = message["attempts"] + 1
+        if result.get("error") not in RETRYABLE_ERRORS or attempts >= self.max_attempts:
+            self._dead_letter(message, attempts, result)
+            return
+
+        delay = result.get("retry_after") or min(self.base_delay * (2 ** (attempts - 1)), self.max_delay)
+        self._append({"op": "retry", "id": message["id"], "attempts": attempts})
+        with self._cond:
+            message["attempts"] = attempts
+            self.retried += 1
+            heapq.heappush(self._ready, (time.monotonic() + delay, next(self._seq), message["id"]))
+            self._cond.notify()
+
+    def _dead_letter(self, message, attempts, result):
+        logging.error(f"发件箱消息 {message['id']} 投递失败 {attempts} 次，转入死信: {result.get('description')}")
+        with self._file_lock:
+            with open(self.dead_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(dict(message, attempts=attempts, error=result.get("error"),
+                                        description=result.get("description"), failed_at=int(time.time())),
+                                   ensure_ascii=False) + "\n")
+        with self._cond:
+            self._messages.pop(message["id"], None)
+            self.dead += 1
+        self._append({"op": "dead", "id": message["id"]})
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": len(self._messages) - self.in_flight,
+                "in_flight": self.in_flight,
+                "delivered": self.delivered,
+                "retried": self.retried,
+                "dead": self.dead,
+            }
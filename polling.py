@@ -0,0 +1,83 @@
+import logging
+import os
+import time
+
+
+class UpdatePoller:
+    """
+    getUpdates 长轮询：没有公网 HTTPS 地址时代替 webhook 接收 update。
+
+    每次最多取 limit 个 update，交给与 webhook 相同的 dispatcher 处理；一批全部处理完后才把
+    offset（最后一个 update_id + 1）写入 offset_file 并在下次请求时确认给 Telegram，
+    因此重启后不会丢 update，最多重放崩溃时正在处理的那一批。
+    """
+
+    def __init__(self, client, dispatcher, offset_file, limit=100, timeout=30,
+                 allowed_updates=("message", "callback_query"), accept=None):
+        self.client = client
+        self.dispatcher = dispatcher
+        self.offset_file = offset_file
+        self.limit = min(limit, 100)
+        self.timeout = timeout
+        self.allowed_updates = list(allowed_updates)
+        # accept(update) 为 False 的 update 直接跳过（与 webhook 的校验一致）
+        self.accept = accept
+        self.offset = self._load_offset()
+        self._running = False
+
+    def _load_offset(self):
+        try:
+            with open(self.offset_file, "r", encoding="utf-8") as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _save_offset(self):
+        tmp_path = self.offset_file + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(self.offset))
+        os.replace(tmp_path, self.offset_file)
+
+    def fetch(self):
+        """取一批 update；请求失败返回 None"""
+        payload = {"limit": self.limit, "timeout": self.timeout, "allowed_updates": self.allowed_updates}
+        if self.offset is not None:
+            payload["offset"] = self.offset
+        result = self.client.request("getUpdates", payload, timeout=self.timeout + 10)
+        if result["status"] != "success":
+            logging.error(f"getUpdates 失败: {result['description']}")
+            return None
+        return result["result"].get("result", [])
+
+    def process(self, updates):
+        for update in updates:
+            if self.accept is None or self.accept(update):
+                # 队列满时等已入队的处理完再继续
+                while not self.dispatcher.submit(update):
+                    self.dispatcher.drain()
+        while not self.dispatcher.drain():
+            pass
+        if updates:
+            self.offset = updates[-1]["update_id"] + 1
+            self._save_offset()
+
+    def run(self):
+        # webhook 与 getUpdates 不能同时使用
+        result = self.client.call("deleteWebhook", {"drop_pending_updates": False}, retries=3)
+        if result["status"] != "success":
+            logging.error(f"删除 webhook 失败，getUpdates 可能无法使用: {result['description']}")
+        logging.info(f"开始长轮询，offset={self.offset}")
+        self._running = True
+        failures = 0
+        while self._running:
+            updates = self.fetch()
+            if updates is None:
+                failures += 1
+                time.sleep(min(2 ** failures, 60))
+                continue
+            failures = 0
+            self.process(updates)
+
+    def stop(self):
+        """当前这次 getUpdates 返回后退出 run()"""
+        self._running = False
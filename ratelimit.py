@@ -0,0 +1,209 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积攒 capacity 个（默认等于 rate，即允许一秒的突发量）"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """有足够令牌时取走并返回 True，否则不等待直接返回 False"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def delay(self, tokens=1):
+        """还要等多少秒才有足够的令牌"""
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (tokens - self._tokens) / self.rate)
+
+    def acquire(self, tokens=1):
+        """阻塞直到取得令牌"""
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def is_full(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens >= self.capacity
+
+
+def is_group_chat(chat_id):
+    """群组、超级群组和频道的 chat_id 为负数，或以 @username 形式给出"""
+    if isinstance(chat_id, str):
+        return chat_id.startswith(("-", "@"))
+    return chat_id < 0
+
+
+class OutboundLimiter:
+    """
+    发往 Telegram 的消息限流：所有请求共用一个全局令牌桶（约 30 条/秒），
+    每个会话另有自己的令牌桶（私聊约 1 条/秒，群组约 20 条/分钟）。
+    收到带 retry_after 的 429 时只暂停对应会话，其他会话照常发送。
+    acquire(wait=False) 不等待会话令牌和暂停，适合处理 update 的线程：发往繁忙会话（比如管理员会话）的消息
+    不应让其他用户的 update 跟着排队。
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60, group_burst=3,
+                 max_wait=60, max_chats=10000):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        # 需要等待超过 max_wait 秒时不再阻塞，直接把限流结果返回给调用方
+        self.max_wait = max_wait
+        self.max_chats = max_chats
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._paused_until = {}
+        self.throttled = 0
+
+    def _bucket(self, chat_id):
+        with self._lock:
+            bucket = self._buckets.get(chat_id)
+            if bucket is None:
+                if len(self._buckets) >= self.max_chats:
+                    self._prune()
+                if is_group_chat(chat_id):
+                    bucket = TokenBucket(self.group_rate, self.group_burst)
+                else:
+                    bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                self._buckets[chat_id] = bucket
+            return bucket
+
+    def _prune(self):
+        """丢掉令牌已经补满的会话桶，重新创建时效果相同"""
+        now = time.monotonic()
+        for chat_id, until in list(self._paused_until.items()):
+            if until <= now:
+                del self._paused_until[chat_id]
+        for chat_id, bucket in list(self._buckets.items()):
+            if chat_id not in self._paused_until and bucket.is_full():
+                del self._buckets[chat_id]
+
+    def paused_for(self, chat_id):
+        with self._lock:
+            until = self._paused_until.get(chat_id)
+        return max(0.0, until - time.monotonic()) if until else 0.0
+
+    def pause(self, chat_id, seconds):
+        """Telegram 要求该会话等待 seconds 秒"""
+        until = time.monotonic() + seconds
+        with self._lock:
+            if until > self._paused_until.get(chat_id, 0):
+                self._paused_until[chat_id] = until
+
+    def chat_delay(self, chat_id):
+        """向 chat_id 发送前还需要等待的秒数（暂停和会话令牌取较大者）"""
+        return max(self.paused_for(chat_id), self._bucket(chat_id).delay())
+
+    def acquire(self, chat_id=None, wait=True, priority=False):
+        """
+        等到可以向 chat_id 发送为止；该会话被暂停超过 max_wait 秒时返回 False。
+        wait=False 时会话被暂停或没有会话令牌就立即返回 False，只有全局令牌仍会等待（最多约 1/global_rate 秒）。
+        priority=True 时不占用会话令牌（只遵守 429 暂停），用于管理员操作触发的少量交互消息，
+        不用排在同一会话大量转发的后面。
+        """
+        if chat_id is not None:
+            paused = self.paused_for(chat_id)
+            if paused > self.max_wait or (paused > 0 and not wait):
+                with self._lock:
+                    self.throttled += 1
+                return False
+            if paused > 0:
+                time.sleep(paused)
+            # 先拿会话令牌再拿全局令牌，等待中的会话不会占用全局配额
+            if not priority:
+                bucket = self._bucket(chat_id)
+                if wait:
+                    bucket.acquire()
+                elif not bucket.try_acquire():
+                    with self._lock:
+                        self.throttled += 1
+                    return False
+        self.global_bucket.acquire()
+        return True
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "chats": len(self._buckets),
+                "paused_chats": sum(1 for until in self._paused_until.values() if until > now),
+                "throttled": self.throttled,
+            }
+
+
+class FloodGuard:
+    """
+    入站防刷：每个用户一个令牌桶（突发 burst 条，之后每秒补充 rate 条），超出的消息直接丢弃。
+    abuse_threshold > 0 时，同一用户在 abuse_window 秒内被丢弃的消息达到该数量，check() 返回 "abuse"（每轮只返回一次）。
+    """
+
+    def __init__(self, rate=1, burst=5, abuse_threshold=0, abuse_window=60, max_users=10000):
+        self.rate = rate
+        self.burst = burst
+        self.abuse_threshold = abuse_threshold
+        self.abuse_window = abuse_window
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._buckets = {}
+        # 用户 -> [本轮第一次被丢弃的时间, 本轮被丢弃的条数]
+        self._strikes = {}
+        self.throttled = 0
+
+    def _bucket(self, user_id):
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                if len(self._buckets) >= self.max_users:
+                    self._prune()
+                bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+            return bucket
+
+    def _prune(self):
+        now = time.monotonic()
+        for user_id, (since, _) in list(self._strikes.items()):
+            if now - since > self.abuse_window:
+                del self._strikes[user_id]
+        for user_id, bucket in list(self._buckets.items()):
+            if user_id not in self._strikes and bucket.is_full():
+                del self._buckets[user_id]
+
+    def check(self, user_id):
+        """返回 "ok"（正常处理）、"throttled"（丢弃）或 "abuse"（丢弃，且达到自动拉黑条件）"""
+        if self._bucket(user_id).try_acquire():
+            return "ok"
+        now = time.monotonic()
+        with self._lock:
+            self.throttled += 1
+            if not self.abuse_threshold:
+                return "throttled"
+            strike = self._strikes.get(user_id)
+            if strike is None or now - strike[0] > self.abuse_window:
+                strike = self._strikes[user_id] = [now, 0]
+            strike[1] += 1
+            if strike[1] == self.abuse_threshold:
+                return "abuse"
+            return "throttled"
@@ -0,0 +1,799 @@
+import bisect
+import copy
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只能使用单进程模式
+    fcntl = None
+
+DEFAULT_STATS = {
+    "messages_received": 0,
+    "users_count": 0,
+    "blacklist_count": 0,
+    "replies_sent": 0,
+    "egg_hits": 0,
+    "messages_throttled": 0
+}
+
+
+def empty_data():
+    return {
+        "users": {},
+        "blacklist": {},
+        "stats": dict(DEFAULT_STATS),
+        "pending_actions": {}
+    }
+
+
+def _dumps(obj):
+    # 紧凑格式走 C 编码器，序列化期间持有 GIL，不会被其他线程的修改打断
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+class JsonStore:
+    """
+    database.json 的进程内存储。
+
+    数据常驻内存，读操作不碰磁盘；每次修改只生成一条紧凑的日志记录，由后台线程按时间间隔
+    （flush_interval 秒）或累计条数（flush_threshold）批量追加到 <path>.journal。
+    日志超过 compact_threshold 条时压缩成新的快照（<path>），快照和新日志都通过临时文件原子替换。
+    启动时先读快照，再按序号重放日志中快照之后的记录。
+
+    shared=True 时可供多个进程（如 gunicorn 多 worker）同时读写：每次操作都持有 <path>.lock 上的
+    文件锁，先追读其他进程追加的日志再执行，写操作在释放锁之前立即追加到日志。
+    其他进程压缩快照时会换掉日志文件，发现跟随的日志已被替换时重新加载。
+
+    get() 返回的是内存中的对象，不要直接修改；读取-修改-写回请使用 update()。
+
+    observer(op, seconds) 在每次落盘相关的操作后调用（op 为 flush、journal_append、snapshot、reload，
+    多进程模式下还有等待文件锁的 lock_wait），这些操作大多发生在后台线程里，调用方看不到。
+    """
+
+    def __init__(self, path, flush_interval=2.0, flush_threshold=100, compact_threshold=10000, fsync=False,
+                 shared=False, observer=None):
+        if shared and fcntl is None:
+            raise RuntimeError("多进程模式需要 fcntl 文件锁，当前平台不支持")
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.compact_threshold = compact_threshold
+        self.fsync = fsync
+        self.shared = shared
+        self.observer = observer
+        self._lock = threading.RLock()
+        self._io_lock = threading.Lock()
+        self._lock_file = None
+        self._data = None
+        # 按用户ID排序的黑名单，分页时才建立，之后随修改增量维护
+        self._blacklist_index = None
+        self._seq = 0
+        self._buffer = []
+        self._journal = None
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._snapshot_needed = False
+        self._wakeup = threading.Event()
+        self._flusher = None
+
+    # --- 加锁 ---
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if not self.shared:
+                if self._data is None:
+                    self._reload()
+                yield
+                return
+
+            if self._lock_file is None:
+                self._lock_file = open(self.path + ".lock", "a")
+            start = time.perf_counter()
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._observe("lock_wait", start)
+            try:
+                if self._data is None or os.fstat(self._journal.fileno()).st_nlink == 0:
+                    self._reload()
+                else:
+                    self._read_journal()
+                yield
+                if self._buffer:
+                    lines, self._buffer = self._buffer, []
+                    self._append_journal(lines)
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _observe(self, op, start):
+        if self.observer is not None:
+            self.observer(op, time.perf_counter() - start)
+
+    # --- 读取与恢复 ---
+    def _reload(self):
+        start = time.perf_counter()
+        self._data, self._seq = self._read_snapshot()
+        self._blacklist_index = None
+        if self._journal is not None:
+            self._journal.close()
+        # 始终保证日志文件存在，其他进程才能通过它是否被替换来判断是否需要重新加载
+        open(self.journal_path, "ab").close()
+        self._journal = open(self.journal_path, "rb")
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._read_journal()
+        self._observe("reload", start)
+
+    def _read_snapshot(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                raw = f.read()
+            if not raw.strip():
+                # 仓库里自带的 database.json 就是空文件，按空库处理
+                return empty_data(), 0
+            data = json.loads(raw)
+        except FileNotFoundError:
+            return empty_data(), 0
+        except json.JSONDecodeError as e:
+            backup = f"{self.path}.corrupt-{int(time.time())}"
+            os.replace(self.path, backup)
+            logging.error(f"数据快照 {self.path} 已损坏（{e}），已备份到 {backup}，仅根据日志恢复")
+            return empty_data(), 0
+
+        seq = data.pop("_seq", 0)
+        for table, default in empty_data().items():
+            data.setdefault(table, default)
+        for name, value in DEFAULT_STATS.items():
+            data["stats"].setdefault(name, value)
+        return data, seq
+
+    def _read_journal(self):
+        self._journal.seek(self._journal_offset)
+        raw = self._journal.read()
+        if not raw:
+            return
+
+        # 进程在写日志时崩溃可能留下半行，截掉它，避免后续追加的记录粘在一起
+        end = raw.rfind(b"\n") + 1
+        if end < len(raw):
+            logging.warning(f"日志 {self.journal_path} 末尾有未写完的记录，已丢弃")
+            os.truncate(self.journal_path, self._journal_offset + end)
+
+        for line in raw[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning(f"跳过无法解析的日志记录：{line[:80]!r}")
+                continue
+            self._journal_records += 1
+            if record["s"] <= self._seq:
+                continue
+            self._apply(record)
+            self._seq = record["s"]
+        self._journal_offset += end
+
+    def _apply(self, record):
+        table = self._data.setdefault(record["t"], {})
+        op = record["o"]
+        if record["t"] == "blacklist" and self._blacklist_index is not None:
+            self._update_blacklist_index(op, record["k"], record["k"] in table)
+        if op == "put":
+            table[record["k"]] = record["v"]
+        elif op == "pop":
+            table.pop(record["k"], None)
+        elif op == "incr":
+            table[record["k"]] = table.get(record["k"], 0) + record["v"]
+
+    def _update_blacklist_index(self, op, key, existed):
+        uid = int(key)
+        if op == "put" and not existed:
+            bisect.insort(self._blacklist_index, uid)
+        elif op == "pop" and existed:
+            del self._blacklist_index[bisect.bisect_left(self._blacklist_index, uid)]
+
+    def _record(self, op, table, key, value=None):
+        self._seq += 1
+        record = {"s": self._seq, "o": op, "t": table, "k": key}
+        if op != "pop":
+            record["v"] = value
+        self._apply(record)
+        self._buffer.append(_dumps(record))
+
+    # --- 兼容 load_data()/save_data() 的整体读写 ---
+    def load(self):
+        with self._locked():
+            return self._data
+
+    def save(self, data):
+        """整体替换数据，下一次落盘时写出完整快照"""
+        with self._locked():
+            self._data = data
+            self._blacklist_index = None
+            self._buffer = []
+            self._snapshot_needed = True
+        self._schedule(force=True)
+
+    # --- 按表读写 ---
+    def get(self, table, key, default=None):
+        with self._locked():
+            return self._data[table].get(key, default)
+
+    def put(self, table, key, value):
+        with self._locked():
+            self._record("put", table, key, value)
+        self._schedule()
+
+    def add(self, table, key, value):
+        """key 不存在时写入并返回 True，已存在时不做修改并返回 False"""
+        with self._locked():
+            if key in self._data[table]:
+                return False
+            self._record("put", table, key, value)
+        self._schedule()
+        return True
+
+    def update(self, table, key, fn, default=None):
+        """原子地读取-修改-写回：fn 接收当前值的副本（不存在时为 default 的副本），返回要写入的新值"""
+        with self._locked():
+            value = fn(copy.deepcopy(self._data[table].get(key, default)))
+            self._record("put", table, key, value)
+        self._schedule()
+        return value
+
+    def pop(self, table, key, default=None):
+        with self._locked():
+            if key not in self._data[table]:
+                return default
+            value = self._data[table][key]
+            self._record("pop", table, key)
+        self._schedule()
+        return value
+
+    def incr(self, table, key, amount=1):
+        with self._locked():
+            self._record("incr", table, key, amount)
+            value = self._data[table][key]
+        self._schedule()
+        return value
+
+    def count(self, table):
+        with self._locked():
+            return len(self._data[table])
+
+    def keys(self, table):
+        with self._locked():
+            return list(self._data[table])
+
+    def items(self, table):
+        with self._locked():
+            return list(self._data[table].items())
+
+    # --- 管理员命令用到的查询 ---
+    def blacklist_page(self, after=None, before=None, limit=10):
+        """
+        按用户ID升序翻页：after 取大于该ID的 limit 条，before 取小于该ID的最后 limit 条，都不传取第一页。
+        返回 ([(用户ID, 拉黑原因, 用户信息)], 是否有上一页, 是否有下一页)
+        """
+        with self._locked():
+            if self._blacklist_index is None:
+                self._blacklist_index = sorted(int(uid) for uid in self._data["blacklist"])
+            index = self._blacklist_index
+            if before is not None:
+                end = bisect.bisect_left(index, int(before))
+                start = max(0, end - limit)
+            else:
+                start = 0 if after is None else bisect.bisect_right(index, int(after))
+                end = start + limit
+            users, blacklist = self._data["users"], self._data["blacklist"]
+            entries = [(str(uid), blacklist[str(uid)], users.get(str(uid), {})) for uid in index[start:end]]
+            return entries, start > 0, end < len(index)
+
+    def broadcast_targets(self):
+        """返回所有不在黑名单中的用户ID"""
+        with self._locked():
+            blacklist = self._data["blacklist"]
+            return [uid for uid in self._data["users"] if uid not in blacklist]
+
+    # --- 落盘 ---
+    def _schedule(self, force=False):
+        # 必须在释放 _lock 之后调用：flush() 的加锁顺序是先 _io_lock 后 _lock
+        if self.flush_interval <= 0 and not self.shared:
+            self.flush()
+            return
+        self._ensure_flusher()
+        if force or len(self._buffer) >= self.flush_threshold:
+            self._wakeup.set()
+
+    def flush(self):
+        start = time.perf_counter()
+        try:
+            self._flush()
+        finally:
+            self._observe("flush", start)
+
+    def _flush(self):
+        if self.shared:
+            # 多进程模式下日志是同步写入的，这里只负责压缩
+            with self._locked():
+                if self._snapshot_needed or self._journal_records >= self.compact_threshold:
+                    self._snapshot_needed = False
+                    self._write_snapshot(_dumps(dict(self._data, _seq=self._seq)))
+            return
+
+        with self._io_lock:
+            with self._lock:
+                if self._data is None:
+                    return
+                snapshot = None
+                if self._snapshot_needed or self._journal_records + len(self._buffer) >= self.compact_threshold:
+                    snapshot = _dumps(dict(self._data, _seq=self._seq))
+                    self._snapshot_needed = False
+                lines, self._buffer = self._buffer, []
+
+            if snapshot is not None:
+                self._write_snapshot(snapshot)
+            elif lines:
+                self._append_journal(lines)
+
+    def _append_journal(self, lines):
+        start = time.perf_counter()
+        payload = ("\n".join(lines) + "\n").encode("utf-8")
+        with open(self.journal_path, "ab") as f:
+            f.write(payload)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        self._journal_offset += len(payload)
+        self._journal_records += len(lines)
+        self._observe("journal_append", start)
+
+    def _write_snapshot(self, payload):
+        start = time.perf_counter()
+        self._replace_file(self.path, payload.encode("utf-8"))
+        # 快照里记录了 _seq，即使在替换日志前崩溃，重放时也会跳过已包含的记录
+        self._replace_file(self.journal_path, b"")
+        self._journal.close()
+        self._journal = open(self.journal_path, "rb")
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._observe("snapshot", start)
+        logging.info(f"数据快照已写入 {self.path}")
+
+    def _replace_file(self, path, payload):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        self._flusher = threading.Thread(target=self._flush_loop, name="db-flusher", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_interval if self.flush_interval > 0 else 5)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"数据落盘失败：{e}")
+
+
+class SqliteStore:
+    """
+    database.json 数据模型的 SQLite 实现（WAL 模式），接口与 JsonStore 一致。
+    每个线程使用独立连接，所有写操作立即提交；/blacklist、/broadcast、/stats 用到的查询都走索引。
+    读取-修改-写回在 BEGIN IMMEDIATE 事务中完成，多线程、多进程共用同一个数据库文件都是安全的。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_seen INTEGER,
+            messages_count INTEGER NOT NULL DEFAULT 0,
+            fallback_count INTEGER,
+            extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_first_seen ON users(first_seen);
+        CREATE TABLE IF NOT EXISTS blacklist (
+            user_id INTEGER PRIMARY KEY,
+            reason TEXT NOT NULL,
+            created_at INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS pending_actions (
+            key TEXT PRIMARY KEY,
+            message_id INTEGER,
+            type TEXT,
+            payload TEXT NOT NULL,
+            created_at INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_pending_message_id ON pending_actions(message_id);
+    """
+
+    # 表名 -> (主键列, 值列)
+    COLUMNS = {
+        "users": ("id", "username, first_seen, messages_count, fallback_count, extra"),
+        "blacklist": ("user_id", "reason"),
+        "stats": ("name", "value"),
+        "pending_actions": ("key", "payload"),
+    }
+    USER_FIELDS = ("username", "first_seen", "messages_count", "fallback_count")
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        conn.executemany("INSERT OR IGNORE INTO stats(name, value) VALUES (?, ?)", DEFAULT_STATS.items())
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # --- 行与值的转换 ---
+    @staticmethod
+    def _key(table, key):
+        return int(key) if table in ("users", "blacklist") else key
+
+    def _decode(self, table, row):
+        if table == "users":
+            user = json.loads(row[4]) if row[4] else {}
+            user.update({"username": row[0], "first_seen": row[1], "messages_count": row[2]})
+            if row[3] is not None:
+                user["fallback_count"] = row[3]
+            return user
+        if table == "pending_actions":
+            return json.loads(row[0])
+        return row[0]
+
+    def _put(self, conn, table, key, value):
+        if table == "users":
+            extra = {k: v for k, v in value.items() if k not in self.USER_FIELDS}
+            conn.execute(
+                "INSERT OR REPLACE INTO users(id, username, first_seen, messages_count, fallback_count, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (int(key), value.get("username"), value.get("first_seen"), value.get("messages_count", 0),
+                 value.get("fallback_count"), json.dumps(extra, ensure_ascii=False) if extra else None))
+        elif table == "blacklist":
+            conn.execute(
+                "INSERT INTO blacklist(user_id, reason, created_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET reason = excluded.reason",
+                (int(key), value, int(time.time())))
+        elif table == "stats":
+            conn.execute("INSERT OR REPLACE INTO stats(name, value) VALUES (?, ?)", (key, value))
+        elif table == "pending_actions":
+            conn.execute(
+                "INSERT OR REPLACE INTO pending_actions(key, message_id, type, payload, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, int(key) if key.isdigit() else None, value.get("type"),
+                 json.dumps(value, ensure_ascii=False), int(time.time())))
+        else:
+            raise KeyError(table)
+
+    # --- 兼容 load_data()/save_data() 的整体读写 ---
+    def load(self):
+        return {table: dict(self.items(table)) for table in self.COLUMNS}
+
+    def save(self, data):
+        """用 data 整体替换数据库内容（迁移时使用）"""
+        with self._transaction() as conn:
+            for table in self.COLUMNS:
+                conn.execute(f"DELETE FROM {table}")
+                for key, value in data.get(table, {}).items():
+                    self._put(conn, table, key, value)
+
+    def flush(self):
+        pass
+
+    # --- 按表读写 ---
+    def _select(self, conn, table, key):
+        pk, columns = self.COLUMNS[table]
+        return conn.execute(f"SELECT {columns} FROM {table} WHERE {pk} = ?", (self._key(table, key),)).fetchone()
+
+    def get(self, table, key, default=None):
+        row = self._select(self._conn(), table, key)
+        return default if row is None else self._decode(table, row)
+
+    def put(self, table, key, value):
+        self._put(self._conn(), table, key, value)
+
+    def add(self, table, key, value):
+        """key 不存在时写入并返回 True，已存在时不做修改并返回 False"""
+        with self._transaction() as conn:
+            if self._select(conn, table, key) is not None:
+                return False
+            self._put(conn, table, key, value)
+        return True
+
+    def update(self, table, key, fn, default=None):
+        """原子地读取-修改-写回：fn 接收当前值（不存在时为 default 的副本），返回要写入的新值"""
+        with self._transaction() as conn:
+            row = self._select(conn, table, key)
+            value = fn(copy.deepcopy(default) if row is None else self._decode(table, row))
+            self._put(conn, table, key, value)
+        return value
+
+    def pop(self, table, key, default=None):
+        pk, _ = self.COLUMNS[table]
+        with self._transaction() as conn:
+            row = self._select(conn, table, key)
+            if row is not None:
+                conn.execute(f"DELETE FROM {table} WHERE {pk} = ?", (self._key(table, key),))
+        return default if row is None else self._decode(table, row)
+
+    def incr(self, table, key, amount=1):
+        if table != "stats":
+            raise KeyError(table)
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO stats(name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (key, amount))
+        return conn.execute("SELECT value FROM stats WHERE name = ?", (key,)).fetchone()[0]
+
+    def count(self, table):
+        return self._conn().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def keys(self, table):
+        pk, _ = self.COLUMNS[table]
+        return [str(row[0]) for row in self._conn().execute(f"SELECT {pk} FROM {table} ORDER BY {pk}")]
+
+    def items(self, table):
+        pk, columns = self.COLUMNS[table]
+        rows = self._conn().execute(f"SELECT {pk}, {columns} FROM {table} ORDER BY {pk}")
+        return [(str(row[0]), self._decode(table, row[1:])) for row in rows]
+
+    # --- 管理员命令用到的查询 ---
+    def blacklist_page(self, after=None, before=None, limit=10):
+        """与 JsonStore.blacklist_page 相同，按主键范围查询，不使用 OFFSET"""
+        conn = self._conn()
+        select = ("SELECT b.user_id, b.reason, u.username, u.first_seen FROM blacklist b "
+                  "LEFT JOIN users u ON u.id = b.user_id ")
+        if before is not None:
+            rows = conn.execute(select + "WHERE b.user_id < ? ORDER BY b.user_id DESC LIMIT ?",
+                                (int(before), limit)).fetchall()[::-1]
+        elif after is not None:
+            rows = conn.execute(select + "WHERE b.user_id > ? ORDER BY b.user_id LIMIT ?",
+                                (int(after), limit)).fetchall()
+        else:
+            rows = conn.execute(select + "ORDER BY b.user_id LIMIT ?", (limit,)).fetchall()
+        entries = []
+        for uid, reason, username, first_seen in rows:
+            user_info = {} if first_seen is None else {"username": username, "first_seen": first_seen}
+            entries.append((str(uid), reason, user_info))
+        if not entries:
+            return entries, False, False
+        exists = "SELECT EXISTS(SELECT 1 FROM blacklist WHERE user_id {} ?)"
+        has_prev = conn.execute(exists.format("<"), (rows[0][0],)).fetchone()[0] == 1
+        has_next = conn.execute(exists.format(">"), (rows[-1][0],)).fetchone()[0] == 1
+        return entries, has_prev, has_next
+
+    def broadcast_targets(self):
+        """返回所有不在黑名单中的用户ID"""
+        rows = self._conn().execute(
+            "SELECT id FROM users WHERE NOT EXISTS (SELECT 1 FROM blacklist WHERE user_id = users.id) ORDER BY id")
+        return [str(row[0]) for row in rows]
+
+
+class StatCounters:
+    """
+    统计计数的内存聚合器：incr() 只在内存里累加增量，
+    由后台线程每 flush_interval 秒（以及退出时）把增量合并进存储的 stats 表。
+    """
+
+    def __init__(self, store, flush_interval=5.0):
+        self.store = store
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flusher = None
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._pending[name] = self._pending.get(name, 0) + amount
+        if self._flusher is None:
+            self._start_flusher()
+
+    def pending(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def snapshot(self):
+        """已落盘的统计值加上尚未合并的增量"""
+        stats = dict(self.store.items("stats"))
+        for name, amount in self.pending().items():
+            stats[name] = stats.get(name, 0) + amount
+        return stats
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        while pending:
+            name, amount = pending.popitem()
+            try:
+                self.store.incr("stats", name, amount)
+            except Exception:
+                # 合并失败时把没写进去的增量放回去，下次再试
+                pending[name] = amount
+                with self._lock:
+                    for name, amount in pending.items():
+                        self._pending[name] = self._pending.get(name, 0) + amount
+                raise
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="stats-flusher", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"统计数据合并失败：{e}")
+
+
+class PendingActions:
+    """
+    等待回复的操作（ForceReply 提示、申诉等），按提示消息的 message_id 存在 pending_actions 表里，查找仍是一次主键访问。
+    每条记录带 expires_at，用最小堆按到期顺序清理；超过 max_entries 条时提前淘汰最早到期的。
+    过期或被淘汰的记录交给 on_expire(key, action)，例如把提示消息改成“已过期”。
+    """
+
+    def __init__(self, store, ttl=86400, max_entries=1000, on_expire=None, sweep_interval=60):
+        self.store = store
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.on_expire = on_expire
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        # key -> expires_at，堆里与之不一致的条目已失效（被取走或重新放入）
+        self._expiry = {}
+        self._heap = []
+        self.expired = 0
+
+        now = time.time()
+        for key, action in self.store.items("pending_actions"):
+            expires_at = action.get("expires_at")
+            if expires_at is None:
+                # 旧版本留下的记录没有过期时间，从现在开始计时
+                expires_at = now + ttl
+                self.store.put("pending_actions", key, dict(action, expires_at=expires_at))
+            self._expiry[key] = expires_at
+            self._heap.append((expires_at, key))
+        heapq.heapify(self._heap)
+
+        self._sweeper = threading.Thread(target=self._sweep_loop, name="pending-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def put(self, key, action, ttl=None):
+        expires_at = time.time() + (ttl or self.ttl)
+        self.store.put("pending_actions", key, dict(action, expires_at=expires_at))
+        evicted = []
+        with self._lock:
+            self._expiry[key] = expires_at
+            heapq.heappush(self._heap, (expires_at, key))
+            while len(self._expiry) > self.max_entries:
+                evicted.append(self._pop_earliest())
+            if len(self._heap) > 2 * len(self._expiry) + 1000:
+                self._heap = [(expires_at, key) for key, expires_at in self._expiry.items()]
+                heapq.heapify(self._heap)
+        for key, expires_at in evicted:
+            self._expire(key, expires_at)
+
+    def pop(self, key):
+        """取出并删除；已过期的返回 None"""
+        action = self.store.pop("pending_actions", key)
+        with self._lock:
+            self._expiry.pop(key, None)
+        if action is None:
+            return None
+        if action.get("expires_at", float("inf")) <= time.time():
+            self._notify(key, action)
+            return None
+        return action
+
+    def _pop_earliest(self):
+        # 调用方需持有 self._lock
+        while True:
+            expires_at, key = heapq.heappop(self._heap)
+            if self._expiry.get(key) == expires_at:
+                del self._expiry[key]
+                return key, expires_at
+
+    def sweep(self):
+        now = time.time()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expires_at, key = heapq.heappop(self._heap)
+                if self._expiry.get(key) == expires_at:
+                    del self._expiry[key]
+                    due.append((key, expires_at))
+        for key, expires_at in due:
+            self._expire(key, expires_at)
+
+    def _expire(self, key, expires_at):
+        action = self.store.pop("pending_actions", key)
+        if action is None:
+            return
+        if action.get("expires_at") != expires_at:
+            # 其他进程刚重新放入了同一个 key，保留
+            self.store.add("pending_actions", key, action)
+            return
+        self._notify(key, action)
+
+    def _notify(self, key, action):
+        with self._lock:
+            self.expired += 1
+        if self.on_expire is not None:
+            try:
+                self.on_expire(key, action)
+            except Exception as e:
+                logging.warning(f"处理过期的待回复操作 {key} 失败：{e}")
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"清理过期的待回复操作失败：{e}")
+
+    def stats(self):
+        with self._lock:
+            return {"pending": len(self._expiry), "expired": self.expired}
+
+
+def migrate_json_to_sqlite(json_path, sqlite_path):
+    """把 database.json（含未压缩的日志）一次性导入 SQLite"""
+    data = JsonStore(json_path).load()
+    SqliteStore(sqlite_path).save(data)
+    logging.info(f"已迁移 {len(data['users'])} 个用户、{len(data['blacklist'])} 条黑名单到 {sqlite_path}")
+
+
+if __name__ == "__main__":
+    # 用法: python storage.py migrate [database.json] [database.db]
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("用法: python storage.py migrate [database.json] [database.db]")
+        sys.exit(1)
+    migrate_json_to_sqlite(sys.argv[2] if len(sys.argv) > 2 else "database.json",
+                           sys.argv[3] if len(sys.argv) > 3 else "database.db")
@@ -0,0 +1,136 @@
+import logging
+import math
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# 这些错误是暂时性的，值得重试；其他错误重试也不会成功，直接返回给调用方
+RETRYABLE_ERRORS = ("too_many_requests", "no_response", "server_error")
+
+
+def classify_error(status_code, body):
+    """把 Telegram 的失败响应归类成 send_message 一直以来返回的错误格式"""
+    body = body or {}
+    description = body.get("description") or f"HTTP {status_code}"
+    lowered = description.lower()
+    result = {"status": "error", "description": description}
+    if status_code == 429 or "too many requests" in lowered:
+        result["error"] = "too_many_requests"
+        result["retry_after"] = body.get("parameters", {}).get("retry_after")
+    elif status_code >= 500 or (not body and status_code < 400):
+        # Telegram 或中间代理的 5xx（常常是 HTML 页面）是暂时性的，只有明确的 4xx 才算失败
+        result["error"] = "server_error"
+    elif "bot was blocked" in lowered:
+        result["error"] = "user_blocked"
+    elif "chat not found" in lowered:
+        result["error"] = "chat_not_found"
+    elif not body:
+        result["error"] = "parse_error"
+        result["description"] = f"无法解析 Telegram API 响应: {description}"
+    else:
+        result["error"] = "api_error"
+    return result
+
+
+class TelegramClient:
+    """
+    Telegram Bot API 客户端：所有调用共用一个带连接池的 requests.Session，
+    连接保持 keep-alive，不再为每个请求重新握手；超时和错误归类也统一在这里处理。
+    传入 limiter（ratelimit.OutboundLimiter）时，每个请求发出前先按全局和会话限流等待。
+    传入 observer 时，每个请求结束后调用 observer(method, result, 耗时秒数)，耗时包含限流等待。
+
+    chat_wait=False 时默认不等待会话限流（见 OutboundLimiter.acquire），会话暂时发不了、或遇到网络错误和 5xx
+    的请求交给 defer(method, payload) 稍后投递（通常是发件箱），call() 返回 {"status": "deferred"}；
+    没有 defer 时直接返回错误。需要真实结果（message_id、是否送达）的调用和后台批量发送应在 call() 时
+    传 wait=True，按会话限流排队并原地重试。
+    """
+
+    def __init__(self, base_url, pool_size=20, timeout=15, limiter=None, observer=None, chat_wait=True,
+                 defer=None):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.limiter = limiter
+        self.observer = observer
+        self.chat_wait = chat_wait
+        self.defer = defer
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, payload=None, timeout=None, wait=None, priority=False):
+        """调用一次 API，返回 {"status": "success", "result": 响应} 或 classify_error() 的结果"""
+        wait = self.chat_wait if wait is None else wait
+        if self.observer is None:
+            return self._request(method, payload, timeout, wait, priority)
+        start = time.perf_counter()
+        result = self._request(method, payload, timeout, wait, priority)
+        try:
+            self.observer(method, result, time.perf_counter() - start)
+        except Exception as e:
+            logging.warning(f"记录 {method} 调用指标失败: {e}")
+        return result
+
+    def _request(self, method, payload, timeout, wait, priority):
+        chat_id = payload.get("chat_id") if payload else None
+        if self.limiter is not None and not self.limiter.acquire(chat_id, wait=wait, priority=priority):
+            delay = max(1, math.ceil(self.limiter.chat_delay(chat_id)))
+            # throttled 表示请求没有发出，是本地限流的结果
+            return {"status": "error", "error": "too_many_requests", "retry_after": delay, "throttled": True,
+                    "description": f"会话 {chat_id} 被限流，还需等待 {delay} 秒"}
+        try:
+            response = self.session.post(f"{self.base_url}/{method}", json=payload,
+                                         timeout=timeout or self.timeout)
+        except requests.exceptions.RequestException as e:
+            return {"status": "error", "error": "no_response", "description": f"无响应内容: {e}"}
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        if response.ok and body and body.get("ok"):
+            return {"status": "success", "result": body}
+        return classify_error(response.status_code, body)
+
+    def call(self, method, payload=None, retries=1, delay=2, timeout=None, wait=None, defer=True, priority=False):
+        """
+        调用 API，失败时最多尝试 retries 次：429 按 Telegram 给出的 retry_after 等待（有 limiter 时只暂停该会话），
+        网络错误和不带 retry_after 的 429 按 delay * 2^n 退避。
+        wait 为 None 时使用构造时的 chat_wait；不等待的调用第一次遇到可重试的错误（含本地限流）就交给 defer，
+        不再原地重试；defer=False 时直接返回该错误。priority 见 OutboundLimiter.acquire。
+        """
+        chat_id = payload.get("chat_id") if payload else None
+        waiting = self.chat_wait if wait is None else wait
+        for attempt in range(retries):
+            result = self.request(method, payload, timeout, waiting, priority)
+            if result["status"] == "success":
+                return result
+            retry_after = result.get("retry_after")
+            if not result.get("throttled"):
+                logging.error(f"调用 {method} 失败 (尝试 {attempt + 1}/{retries}): {result['description']}")
+                if retry_after and self.limiter is not None and chat_id is not None:
+                    # 暂停记录在 limiter 中，之后发往该会话的请求（包括下面的重试）都会先等待
+                    self.limiter.pause(chat_id, retry_after)
+            if not waiting and result["error"] in RETRYABLE_ERRORS:
+                # 不等待的调用：会话被限流，或 Telegram/网络暂时出错时，交给 defer 稍后投递，
+                # 不在这里退避重试、占用处理 update 的线程
+                if defer and self.defer is not None:
+                    self.defer(method, payload)
+                    if result.get("throttled"):
+                        logging.info(f"会话 {chat_id} 被限流，{method} 已转入稍后投递")
+                    else:
+                        logging.info(f"{method} 暂时失败（{result['error']}），已转入稍后投递")
+                    return {"status": "deferred", "result": {}}
+                if retry_after and self.limiter is not None and chat_id is not None:
+                    return result
+            if retry_after and self.limiter is not None and chat_id is not None and retry_after > self.limiter.max_wait:
+                return result
+            if result["error"] not in RETRYABLE_ERRORS or attempt == retries - 1:
+                return result
+            if retry_after:
+                if self.limiter is None or chat_id is None:
+                    time.sleep(retry_after)
+            else:
+                time.sleep(delay * (2 ** attempt))
+        return result
@@ -0,0 +1,196 @@
+import cProfile
+import functools
+import io
+import logging
+import logging.handlers
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Span:
+    __slots__ = ("name", "attrs", "start", "end", "children")
+
+    def __init__(self, name, attrs, start):
+        self.name = name
+        self.attrs = attrs
+        self.start = start
+        self.end = None
+        self.children = []
+
+
+class Tracer:
+    """
+    按比例抽样的请求追踪：trace() 包住一次 update 的处理，期间同一线程里的 span() 记录成嵌套的调用树。
+    耗时超过 slow_threshold 秒的 update 把调用树（以及开启 profile 时的 cProfile 统计）写入可轮转的 path。
+
+    sample_rate 为 0 时 traced() 和 wrap() 直接返回原对象，对热路径没有额外开销；
+    未被抽中的 update 里 span() 只多一次线程局部变量的读取。
+    """
+
+    def __init__(self, sample_rate=0.0, slow_threshold=1.0, path="slow_updates.log", max_bytes=10 * 1024 * 1024,
+                 backup_count=3, profile=False, profile_limit=30, max_spans=500):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.path = path
+        self.profile = profile
+        self.profile_limit = profile_limit
+        self.max_spans = max_spans
+        self._local = threading.local()
+        # 同一时间只允许一个线程开启 cProfile
+        self._profile_lock = threading.Lock()
+        self._logger = None
+        self._logger_lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self.sampled = 0
+        self.dumped = 0
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    # --- 记录 ---
+    @contextmanager
+    def trace(self, name, **attrs):
+        """一次 update 的根 span；未抽中或已在追踪中时什么也不做"""
+        if not self.enabled or getattr(self._local, "stack", None) or random.random() >= self.sample_rate:
+            yield
+            return
+
+        root = Span(name, attrs, time.perf_counter())
+        self._local.stack = [root]
+        self._local.count = 1
+        profiler = None
+        if self.profile and self._profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # 已有其他分析工具在运行
+                self._profile_lock.release()
+                profiler = None
+        try:
+            yield
+        finally:
+            root.end = time.perf_counter()
+            self._local.stack = None
+            if profiler is not None:
+                profiler.disable()
+                self._profile_lock.release()
+            self.sampled += 1
+            if root.end - root.start >= self.slow_threshold:
+                self._dump(root, profiler)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        stack = getattr(self._local, "stack", None)
+        if not stack or self._local.count >= self.max_spans:
+            yield
+            return
+        span = Span(name, attrs, time.perf_counter())
+        stack[-1].children.append(span)
+        stack.append(span)
+        self._local.count += 1
+        try:
+            yield
+        finally:
+            span.end = time.perf_counter()
+            stack.pop()
+
+    def record(self, name, seconds, **attrs):
+        """补记一个刚结束、耗时 seconds 的 span，用于只能在事后拿到耗时的回调（如 TelegramClient 的 observer）"""
+        stack = getattr(self._local, "stack", None)
+        if not stack or self._local.count >= self.max_spans:
+            return
+        end = time.perf_counter()
+        span = Span(name, attrs, end - seconds)
+        span.end = end
+        stack[-1].children.append(span)
+        self._local.count += 1
+
+    def traced(self, name=None):
+        """装饰器：把函数调用记录为 span"""
+        def decorator(fn):
+            if not self.enabled:
+                return fn
+            span_name = name or fn.__name__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def wrap(self, obj, methods, prefix):
+        """返回一个代理，obj 的 methods 调用记录为 "prefix.方法名" 的 span，其他属性原样转发"""
+        if not self.enabled:
+            return obj
+        return _TracedProxy(self, obj, methods, prefix)
+
+    # --- 输出 ---
+    def _get_logger(self):
+        with self._logger_lock:
+            if self._logger is None:
+                logger = logging.getLogger(f"{__name__}.slow")
+                logger.propagate = False
+                logger.setLevel(logging.INFO)
+                handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=self._max_bytes,
+                                                               backupCount=self._backup_count, encoding="utf-8")
+                handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+                logger.addHandler(handler)
+                self._logger = logger
+            return self._logger
+
+    @staticmethod
+    def format_tree(root):
+        lines = []
+
+        def walk(span, depth):
+            attrs = "".join(f" {key}={value}" for key, value in span.attrs.items())
+            offset = (span.start - root.start) * 1000
+            duration = ((span.end or span.start) - span.start) * 1000
+            lines.append(f"{'  ' * depth}{span.name}{attrs}  +{offset:.1f}ms  {duration:.1f}ms")
+            for child in span.children:
+                walk(child, depth + 1)
+
+        walk(root, 0)
+        return "\n".join(lines)
+
+    def _dump(self, root, profiler):
+        text = self.format_tree(root)
+        if profiler is not None:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(self.profile_limit)
+            text += "\n" + out.getvalue().rstrip()
+        try:
+            self._get_logger().info("慢 update\n" + text + "\n")
+            self.dumped += 1
+        except OSError as e:
+            logging.error(f"写入慢 update 记录失败: {e}")
+            return
+        logging.warning(f"{root.name} 处理耗时 {(root.end - root.start) * 1000:.0f}ms，调用树已写入 {self.path}")
+
+    def stats(self):
+        return {"sample_rate": self.sample_rate, "sampled": self.sampled, "dumped": self.dumped}
+
+
+class _TracedProxy:
+    def __init__(self, tracer, obj, methods, prefix):
+        self._obj = obj
+        for method in methods:
+            setattr(self, method, self._traced(tracer, getattr(obj, method), f"{prefix}.{method}"))
+
+    @staticmethod
+    def _traced(tracer, fn, name):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def __getattr__(self, name):
+        return getattr(self._obj, name)